@@ -0,0 +1,270 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import main as reser_main
+from config import ReserConfig
+from fakecatalog import FakeCatalog
+from fakeservers import FakeShippoServer, FakeSmartetailingServer
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Benchmark against local stand-in servers")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    shippo_parser = subparsers.add_parser('syncshippo', help="Benchmark main.sync_shippo")
+    shippo_parser.add_argument('--orders', type=int, nargs='+', default=[100, 1000, 10000],
+                               help="Exported order counts to benchmark")
+    shippo_parser.add_argument('--existing', type=float, default=0.5,
+                               help="Fraction of the exported orders already in Shippo")
+    shippo_parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    shippo_parser.add_argument('--rate-limit', type=float, default=0.0,
+                               help="Fraction of Shippo requests answered with 429")
+    shippo_parser.add_argument('--failure-rate', type=float, default=0.0,
+                               help="Fraction of Shippo requests answered with 500")
+    shippo_parser.add_argument('--max-workers', type=int, default=4, help="Shippo concurrency")
+
+    datafeed_parser = subparsers.add_parser('datafeed', help="Benchmark the datafeed stages on a synthetic catalog")
+    datafeed_parser.add_argument('--items', type=int, nargs='+', default=[10000, 100000],
+                                 help="Catalog sizes to benchmark, up to 500000")
+    datafeed_parser.add_argument('--shops', type=int, default=3, help="Shops besides the all-shops total")
+    datafeed_parser.add_argument('--sales', type=float, default=0.2, help="Sales per catalog item")
+    datafeed_parser.add_argument('--seed', type=int, default=0, help="Catalog random seed")
+    datafeed_parser.add_argument('--repeat', type=int, default=3, help="Timed runs per stage, the fastest counts")
+    datafeed_parser.add_argument('--baseline', default='benchmark_datafeed.json',
+                                 help="Baseline results to compare against")
+    datafeed_parser.add_argument('--save-baseline', action='store_true',
+                                 help="Save these results as the baseline instead of comparing")
+    datafeed_parser.add_argument('--tolerance', type=float, default=0.2,
+                                 help="Fraction slower than the baseline a stage may be before it fails")
+    return parser.parse_args()
+
+
+def create_benchmark_config(etailing_url: str, shippo_url: str, index_file: str, max_workers: int) -> Dict:
+    return {
+        "smartetailing": {
+            "base_url": etailing_url,
+            "merchant_id": "1",
+            "url_key": "benchmark",
+            "web_url": etailing_url,
+            "username": "benchmark",
+            "password": "benchmark"
+        },
+        "shippo": {
+            "apikey": "benchmark",
+            "base_url": shippo_url,
+            "include_order_status": ["received", "processing"],
+            "index_file": index_file,
+            "max_workers": max_workers
+        },
+        "return_address": {
+            "city": "Newport",
+            "company": "Reser Bicycle",
+            "country": "US",
+            "email": "support@reserbicycle.com",
+            "name": "Reser Bicycle",
+            "phone": "+1 859 261 6187",
+            "state": "KY",
+            "street1": "648 Monmouth Street",
+            "street2": "",
+            "zip": "41071"
+        }
+    }
+
+
+def benchmark_sync_shippo(order_count: int, args) -> Dict[str, float]:
+    """
+    Run main.sync_shippo against fresh stand-in servers, once for timing and once under tracemalloc,
+    since tracing allocations slows the run down several times over.
+    """
+    wall_time, request_count, created_count = run_sync_shippo(order_count, args, trace_memory=False)
+    _, _, peak_memory = run_sync_shippo(order_count, args, trace_memory=True)
+    return {'orders': order_count,
+            'wall_sec': wall_time,
+            'requests': request_count,
+            'created': created_count,
+            'peak_mb': peak_memory / 2 ** 20}
+
+
+def run_sync_shippo(order_count: int, args, trace_memory: bool) -> Tuple[float, int, int]:
+    """
+    :return: wall time in seconds, request count and either the created order count or the peak traced bytes
+    """
+    etailing_server = FakeSmartetailingServer(order_count, latency=args.latency)
+    existing_count = int(order_count * args.existing)
+    shippo_server = FakeShippoServer(['#' + order_id for order_id in etailing_server.order_ids[:existing_count]],
+                                     latency=args.latency, rate_limit_rate=args.rate_limit,
+                                     failure_rate=args.failure_rate)
+    with etailing_server, shippo_server, tempfile.TemporaryDirectory() as temp_dir:
+        ReserConfig.set_config(create_benchmark_config(etailing_server.url, shippo_server.url,
+                                                       os.path.join(temp_dir, 'shippo_orders.json'),
+                                                       args.max_workers))
+        if trace_memory:
+            tracemalloc.start()
+        time_start = time.perf_counter()
+        try:
+            reser_main.sync_shippo()
+        except RuntimeError as err:
+            # Injected failures that ran out of retries, the rest of the batch still counts.
+            logging.warning(err)
+        wall_time = time.perf_counter() - time_start
+        if trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            return wall_time, etailing_server.request_count + shippo_server.request_count, peak_memory
+
+    return wall_time, etailing_server.request_count + shippo_server.request_count, shippo_server.created_order_count
+
+
+def print_results(results: List[Dict[str, float]]) -> None:
+    print(f"{'orders':>8} {'wall_sec':>9} {'requests':>9} {'created':>8} {'peak_mb':>8}")
+    for result in results:
+        print(f"{result['orders']:>8} {result['wall_sec']:>9.2f} {result['requests']:>9} "
+              f"{result['created']:>8} {result['peak_mb']:>8.1f}")
+
+
+def datafeed_stages(temp_dir: str) -> List[Tuple[str, str, Callable[[Dict[str, Any]], Any]]]:
+    """
+    The feed path of main.inventory_spreadsheet, in order
+    :return: stage name, the input it counts records of, and the stage, which takes the outputs of earlier stages
+    """
+    from datafeed import ShopQuantities, get_report_rows, get_shop_report_rows, render_report_rows
+    from lightspeedobjects import Item, Sale
+    from salesstore import SalesStore
+
+    def sales_velocity(outputs: Dict[str, Any]):
+        store = SalesStore(os.path.join(temp_dir, f"sales_{time.perf_counter_ns()}.db"))
+        today = date.fromisoformat(outputs['today'])
+        store.replace_days(today - timedelta(days=89), today, outputs['decode_sales'], today)
+        return store.velocity(today=today)
+
+    def render_shop_report_rows(outputs: Dict[str, Any]):
+        # Full and MPN exports of every shop and all shops, as create_and_upload_inventory renders them
+        velocity = outputs['sales_velocity']
+        return dict([(shop_id, render_report_rows(rows(), velocity.columns))
+                     for shop_id, rows in get_shop_report_rows(outputs['shop_quantities'], True, velocity).items()])
+
+    return [
+        ('decode_items', 'items', lambda outputs: Item.from_json_list(outputs['items'])),
+        ('decode_sales', 'sales', lambda outputs: Sale.from_json_list(outputs['sales'])),
+        ('sales_velocity', 'sales', sales_velocity),
+        ('get_report_rows', 'items', lambda outputs: list(get_report_rows(outputs['decode_items'],
+                                                                          outputs['sales_velocity']))),
+        ('render_report_rows', 'items', lambda outputs: render_report_rows(outputs['get_report_rows'],
+                                                                           outputs['sales_velocity'].columns)),
+        ('shop_quantities', 'items', lambda outputs: ShopQuantities(outputs['decode_items'])),
+        ('render_shop_report_rows', 'items', render_shop_report_rows),
+    ]
+
+
+def benchmark_datafeed(item_count: int, args) -> List[Dict[str, Any]]:
+    """
+    Run every datafeed stage on a synthetic catalog, repeat times for timing and once more under tracemalloc
+    for each stage's peak memory above what it started with.
+    """
+    catalog = FakeCatalog(item_count, args.shops, args.seed)
+    inputs = {'items': catalog.items(), 'sales': catalog.sales(int(item_count * args.sales)),
+              'today': catalog.now.date().isoformat()}
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        stages = datafeed_stages(temp_dir)
+        wall_times = dict([(name, float('inf')) for name, _, _ in stages])
+        for _ in range(args.repeat):
+            outputs = dict(inputs)
+            for name, _, stage in stages:
+                gc.collect()
+                time_start = time.perf_counter()
+                outputs[name] = stage(outputs)
+                wall_times[name] = min(wall_times[name], time.perf_counter() - time_start)
+
+        outputs = dict(inputs)
+        tracemalloc.start()
+        for name, records, stage in stages:
+            gc.collect()
+            start_memory, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            outputs[name] = stage(outputs)
+            _, peak_memory = tracemalloc.get_traced_memory()
+            record_count = len(inputs[records])
+            results.append({'items': item_count,
+                            'stage': name,
+                            'records': record_count,
+                            'wall_sec': wall_times[name],
+                            'per_sec': record_count / wall_times[name] if wall_times[name] else 0.0,
+                            'peak_mb': (peak_memory - start_memory) / 2 ** 20})
+        tracemalloc.stop()
+    return results
+
+
+def compare_to_baseline(results: List[Dict[str, Any]], baseline: Optional[List[Dict[str, Any]]],
+                        tolerance: float) -> bool:
+    """
+    Print each stage's results beside the baseline's
+    :return: True if no stage is more than tolerance slower than the baseline
+    """
+    baseline_results = dict([((result['items'], result['stage']), result) for result in baseline or []])
+    passed = True
+    print(f"{'items':>7} {'stage':<23} {'records':>8} {'wall_sec':>9} {'per_sec':>11} {'peak_mb':>8} "
+          f"{'vs_base':>8} {'mem_base':>8}")
+    for result in results:
+        base = baseline_results.get((result['items'], result['stage']))
+        comparison = ''
+        if base and base['wall_sec']:
+            time_ratio = result['wall_sec'] / base['wall_sec']
+            memory_ratio = result['peak_mb'] / base['peak_mb'] if base['peak_mb'] else 1.0
+            comparison = f"{time_ratio:>7.2f}x {memory_ratio:>7.2f}x"
+            if time_ratio > 1 + tolerance:
+                comparison += ' SLOWER'
+                passed = False
+        print(f"{result['items']:>7} {result['stage']:<23} {result['records']:>8} {result['wall_sec']:>9.3f} "
+              f"{result['per_sec']:>11.0f} {result['peak_mb']:>8.1f} {comparison}")
+    return passed
+
+
+def run_datafeed_benchmark(args) -> int:
+    """
+    :return: exit code, 1 if a stage regressed against the baseline
+    """
+    results = []
+    for item_count in args.items:
+        results += benchmark_datafeed(item_count, args)
+    shape = {'shops': args.shops, 'sales': args.sales, 'seed': args.seed}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'shape': shape, 'results': results}, f, indent=2)
+        compare_to_baseline(results, None, args.tolerance)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved['shape'] != shape:
+            logging.warning(f"Baseline {args.baseline} is for catalog {saved['shape']}, not {shape}")
+        baseline = saved['results']
+    return 0 if compare_to_baseline(results, baseline, args.tolerance) else 1
+
+
+def main():
+    """
+    Benchmark entry point, e.g. python benchmark.py syncshippo --orders 100 1000 10000
+    or python benchmark.py datafeed --items 10000 100000 500000
+    """
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s', level=logging.WARNING, stream=sys.stderr)
+    args = parse_arguments()
+    if args.command == 'syncshippo':
+        print_results([benchmark_sync_shippo(order_count, args) for order_count in args.orders])
+    elif args.command == 'datafeed':
+        sys.exit(run_datafeed_benchmark(args))
+
+
+if __name__ == '__main__':
+    main()
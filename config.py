@@ -12,6 +12,14 @@ class ReserConfig:
             ReserConfig.__config = ReserConfig.__load_config()
         return ReserConfig.__config
 
+    @staticmethod
+    def set_config(config: dict) -> None:
+        """
+        Use an explicit configuration instead of config.json, e.g. to point the connections at local servers
+        :param config: full configuration, secrets already filled in
+        """
+        ReserConfig.__config = config
+
     @staticmethod
     def __load_config():
         try:
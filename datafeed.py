@@ -1,129 +1,346 @@
+import base64
+import csv
+import functools
+import gzip
+import hashlib
+import io
 import logging
 import os
-from typing import Iterator, Dict, List, Union
+import posixpath
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, Dict, List, Iterable, Tuple, TextIO, Optional, Callable
 
 import boto3
+import botocore.exceptions
 import urllib.parse
 
-import pandas
+import numpy as np
 
 from config import ReserConfig
+from feedsnapshot import FeedSnapshot
+from lightspeedobjects import Item
+from runreport import span, submit_in_context
+from salesstore import SalesVelocity
 
 
-def get_sale_items(recent_sales):
-    return list(get_items_from_sale_lines(get_sale_lines(recent_sales)))
+REPORT_COLUMNS = ['System ID', 'UPC', 'EAN', 'Custom SKU', 'Manufact. SKU', 'Item', 'Remaining', 'Total Cost',
+                  'Avg. Cost', 'Sale Price', 'Margin']
+MPN_REPORT_COLUMNS = ['Manufact. SKU', 'Remaining']
 
 
-def get_sale_lines(all_sales: List[Union[List, Dict]]) -> Iterator[Dict]:
-    for sale in all_sales:
-        try:
-            lines = sale['SaleLines']['SaleLine']
-            if isinstance(lines, list):
-                for line_item in lines:
-                    yield line_item
-            else:
-                yield lines
-        except KeyError:
-            pass
+def margin(price, cost) -> float:
+    return (price - cost) / price if price > 0 else 0.0
 
 
-def get_items_from_sale_lines(sale_lines: Iterator[Dict]) -> Iterator[Dict]:
-    for line in sale_lines:
-        try:
-            line_items = line['Item']
-            if isinstance(line, list):
-                for item in line_items:
-                    yield item
-            else:
-                yield line_items
-        except KeyError:
-            pass
+# Lightspeed's ItemShop for shopID 0 holds the item's totals across every shop.
+ALL_SHOPS = 0
 
 
-def margin(price, cost) -> float:
-    return (price - cost) / price if price > 0 else 0.0
+def qoh(item: Item, shop_id: int = ALL_SHOPS) -> int:
+    """
+    :param shop_id: shop to count, ALL_SHOPS for the total across shops
+    """
+    for shop in item.ItemShops:
+        if shop.shopID == shop_id:
+            return shop.qoh
+    if shop_id == ALL_SHOPS:
+        return sum([shop.qoh for shop in item.ItemShops])
+    return 0
 
 
-def qoh(item):
-    # TODO - Handle other shops?
-    try:
-        return int(item['ItemShops']['ItemShop'][0]['qoh'])
-    except KeyError:
-        return 0
-
-
-def get_report_item(item) -> dict:
-    return {'System ID': item['systemSku'],
-            'UPC': int(item['upc'] or "0"),
-            'EAN': item['ean'],
-            'Custom SKU': item['customSku'],
-            'Manufact. SKU': item['manufacturerSku'],
-            'Item': item['description'],
-            'Remaining': qoh(item),
-            'Total Cost': float(item['defaultCost']),
-            'Avg. Cost': float(item['avgCost']),  # TODO - Handle rewriting this with default if 0
-            'Sale Price': float(item['Prices']['ItemPrice'][0]['amount']),  # TODO - Handle finding the MSRP
-            'Margin': margin(float(item['Prices']['ItemPrice'][0]['amount']), float(item['defaultCost']))
-            }
-
-
-def create_and_upload_recent_sale(aws_config, report_items):
-    report_df = create_dataframe(report_items)
-    csv_file, mpn_csv_file = write_to_csv_file(report_df, aws_config['recent_sale_export_file'],
-                                               aws_config['recent_sale_mpn_export_file'])
-    upload_to_s3(csv_file, aws_config['s3_recent_sale_file_uri'])
-    upload_to_s3(mpn_csv_file, aws_config['s3_recent_sale_mpn_file_uri'])
-
-
-def create_and_upload_inventory(aws_config, inventory_items):
-    inventory_df = create_dataframe(inventory_items)
-    csv_file, mpn_csv_file = write_to_csv_file(inventory_df, aws_config['export_file'], aws_config['mpn_export_file'])
-    upload_to_s3(csv_file, aws_config['s3_file_uri'])
-    upload_to_s3(mpn_csv_file, aws_config['s3_mpn_file_uri'])
-
-
-def create_dataframe(inventory_items):
-    # Reporting dataframe
-    inventory_df = pandas.DataFrame(inventory_items)
-    # Handle currency and percent columns.
-    inventory_df['UPC'] = inventory_df['UPC'].apply(lambda x: f'{x:014.0f}')
-    inventory_df['Total Cost'] = inventory_df['Total Cost'].apply(lambda x: f'${x:.2f}')
-    inventory_df['Avg. Cost'] = inventory_df['Avg. Cost'].apply(lambda x: f'${x:.2f}')
-    inventory_df['Sale Price'] = inventory_df['Sale Price'].apply(lambda x: f'${x:.2f}')
-    inventory_df['Margin'] = inventory_df['Margin'].apply(lambda x: f'{x * 100:4.2f}%')
-    # Zero blank Manufacturing SKUs for datafeedwatch merge.
-    inventory_df['Manufact. SKU'] = inventory_df['Manufact. SKU'].apply(lambda x: '0' if not x else x)
-    return inventory_df
-
-
-def write_to_csv_file(df, export_file, mpn_export_file):
-    logging.info("Writing data frame to export csv")
-    dir_path: str = os.path.dirname(os.path.realpath(__file__))
-    csv_file = os.path.join(dir_path, export_file)
-    df.to_csv(csv_file, index=False)
-    logging.info("Writing MPN data to csv")
-    # Secondary feed is solely MPN and quantity
-    mpn_qty_df = df[['Manufact. SKU', 'Remaining']]
-    mpn_qty_df = mpn_qty_df[mpn_qty_df['Manufact. SKU'] != '']
-    mpn_csv_file = os.path.join(dir_path, mpn_export_file)
-    mpn_qty_df.to_csv(mpn_csv_file, index=False)
-    return csv_file, mpn_csv_file
-
-
-def upload_to_s3(csv_file, s3_csv_uri):
+class ShopQuantities:
+    """
+    Quantity on hand of every item in every shop, gathered in a single pass over the items so each shop's
+    feed comes from the same download.
+    """
+
+    def __init__(self, items: Iterable[Item]):
+        self.items: List[Item] = []
+        self.shop_ids: List[int] = []
+        shop_columns: Dict[int, int] = dict()
+        rows, columns, quantities, totals = [], [], [], []
+        for row, item in enumerate(items):
+            self.items.append(item)
+            total = None
+            shop_sum = 0
+            for shop in item.ItemShops:
+                shop_id = shop.shopID
+                quantity = shop.qoh
+                if shop_id == ALL_SHOPS:
+                    total = quantity
+                    continue
+                if shop_id not in shop_columns:
+                    shop_columns[shop_id] = len(self.shop_ids)
+                    self.shop_ids.append(shop_id)
+                rows.append(row)
+                columns.append(shop_columns[shop_id])
+                quantities.append(quantity)
+                shop_sum += quantity
+            totals.append(shop_sum if total is None else total)
+        # Item by shop, in the order of shop_ids.
+        self.matrix = np.zeros((len(self.items), len(self.shop_ids)), dtype=np.int64)
+        self.matrix[rows, columns] = quantities
+        self.total = np.array(totals, dtype=np.int64)
+
+    def quantities(self, shop_id: int = ALL_SHOPS) -> np.ndarray:
+        """
+        :return: quantity of each item in the shop
+        """
+        if shop_id == ALL_SHOPS:
+            return self.total
+        return self.matrix[:, self.shop_ids.index(shop_id)]
+
+
+def get_report_row(item: Item, remaining: int = None) -> List:
+    """
+    One display formatted report row
+    :param remaining: quantity to report, qoh(item) by default
+    """
+    sale_price = item.price  # TODO - Handle finding the MSRP
+    total_cost = item.defaultCost
+    return [item.systemSku,
+            '%014.0f' % int(item.upc or "0"),
+            item.ean,
+            item.customSku,
+            # Zero blank Manufacturing SKUs for datafeedwatch merge.
+            item.manufacturerSku or '0',
+            item.description,
+            qoh(item) if remaining is None else remaining,
+            '$%.2f' % total_cost,
+            '$%.2f' % item.avgCost,  # TODO - Handle rewriting this with default if 0
+            '$%.2f' % sale_price,
+            '%4.2f%%' % (margin(sale_price, total_cost) * 100)]
+
+
+def create_and_upload_recent_sale(aws_config, items, velocity: SalesVelocity = None,
+                                  snapshot: FeedSnapshot = None) -> List[Future]:
+    """
+    :param items: Lightspeed items, a collection since the delta feed reads them again
+    :param velocity: adds sales velocity columns to the full export
+    :param snapshot: also upload delta feeds of the rows changed since the snapshot
+    :return: pending S3 uploads, see wait_for_uploads
+    """
+    # Rows are formatted again for the delta feed rather than holding the whole feed in memory.
+    return submit_feed_uploads(lambda: get_report_rows(items, velocity), velocity.columns if velocity else None,
+                               aws_config, aws_config['s3_recent_sale_file_uri'],
+                               aws_config['s3_recent_sale_mpn_file_uri'], snapshot)
+
+
+def create_and_upload_inventory(aws_config, items, velocity: SalesVelocity = None,
+                                snapshot: FeedSnapshot = None) -> List[Future]:
+    """
+    Upload the all-shops feeds, and a feed per shop when s3_shop_file_uri and s3_shop_mpn_file_uri are configured.
+    The shop uris are templates filled in with {shop_id}.
+    :param velocity: adds sales velocity columns to the full exports
+    :param snapshot: also upload delta feeds of the rows changed since the snapshot
+    :return: pending S3 uploads, see wait_for_uploads
+    """
+    shop_rows = get_shop_report_rows(ShopQuantities(items), 's3_shop_file_uri' in aws_config, velocity)
+    extra_columns = velocity.columns if velocity else None
+    uploads = submit_feed_uploads(shop_rows.pop(ALL_SHOPS), extra_columns, aws_config,
+                                  aws_config['s3_file_uri'], aws_config['s3_mpn_file_uri'], snapshot)
+    for shop_id, rows in shop_rows.items():
+        uploads += submit_feed_uploads(rows, extra_columns, aws_config,
+                                       aws_config['s3_shop_file_uri'].format(shop_id=shop_id),
+                                       aws_config['s3_shop_mpn_file_uri'].format(shop_id=shop_id), snapshot)
+    return uploads
+
+
+def create_feed_snapshot(db_file: str) -> FeedSnapshot:
+    """
+    Snapshot for delta feeds, a row changes with its quantity, cost or price
+    """
+    return FeedSnapshot(db_file, REPORT_COLUMNS.index('System ID'), REPORT_COLUMNS.index('Remaining'),
+                        [REPORT_COLUMNS.index(column) for column in ['Remaining', 'Total Cost', 'Sale Price']])
+
+
+def submit_feed_uploads(rows: Callable[[], Iterable[List]], extra_columns: Optional[List[str]], aws_config,
+                        s3_uri: str, s3_mpn_uri: str, snapshot: FeedSnapshot = None) -> List[Future]:
+    """
+    Render a feed and its MPN feed, and upload them in each of aws_config's feed_formats (csv by default).
+    With a snapshot the delta feeds are uploaded too, see delta_uri.
+    :param rows: returns the feed's report rows, called again for the delta feed
+    """
+    feed_formats = aws_config.get('feed_formats', ['csv'])
+    for feed_format in feed_formats:
+        if feed_format not in FEED_FORMATS:
+            raise ValueError(f"Unknown feed format {feed_format}, expected one of {FEED_FORMATS}")
+    feeds = [(render_report_rows(rows(), extra_columns), s3_uri, s3_mpn_uri)]
+    if snapshot:
+        feeds.append((render_report_rows(snapshot.delta(s3_uri, rows()), extra_columns),
+                      delta_uri(s3_uri), delta_uri(s3_mpn_uri)))
+    uploads = []
+    for (csv_data, mpn_csv_data), csv_uri, mpn_csv_uri in feeds:
+        for feed_format in feed_formats:
+            uploads.append(submit_in_context(get_upload_executor(), upload_feed, csv_data, csv_uri, feed_format))
+            uploads.append(submit_in_context(get_upload_executor(), upload_feed, mpn_csv_data, mpn_csv_uri,
+                                             feed_format))
+    return uploads
+
+
+def write_report_rows(rows: Iterable[List], csv_stream: TextIO, mpn_csv_stream: TextIO,
+                      extra_columns: List[str] = None) -> None:
+    """
+    :param rows: rows from get_report_row, followed by any extra column values
+    :param extra_columns: full export columns after REPORT_COLUMNS
+    """
+    mpn_index, remaining_index = [REPORT_COLUMNS.index(column) for column in MPN_REPORT_COLUMNS]
+    # Line endings and quoting match pandas.DataFrame.to_csv.
+    csv_writer = csv.writer(csv_stream, lineterminator=os.linesep)
+    mpn_csv_writer = csv.writer(mpn_csv_stream, lineterminator=os.linesep)
+    csv_writer.writerow(REPORT_COLUMNS + (extra_columns or []))
+    mpn_csv_writer.writerow(MPN_REPORT_COLUMNS)
+    for row in rows:
+        csv_writer.writerow(row)
+        # Secondary feed is solely MPN and quantity
+        if row[mpn_index] != '':
+            mpn_csv_writer.writerow([row[mpn_index], row[remaining_index]])
+
+
+def get_report_rows(items: Iterable[Item], velocity: SalesVelocity = None) -> Iterator[List]:
+    """
+    :param velocity: adds sales velocity columns to each row
+    """
+    for item in items:
+        row = get_report_row(item)
+        yield row + velocity.row(row[0]) if velocity else row
+
+
+def render_report_rows(rows: Iterable[List], extra_columns: List[str] = None) -> Tuple[bytes, bytes]:
+    with span('feed.csv') as data:
+        csv_buffer = io.StringIO(newline='')
+        mpn_csv_buffer = io.StringIO(newline='')
+        write_report_rows(rows, csv_buffer, mpn_csv_buffer, extra_columns)
+        csv_data, mpn_csv_data = csv_buffer.getvalue().encode('utf-8'), mpn_csv_buffer.getvalue().encode('utf-8')
+        data['bytes'] = len(csv_data) + len(mpn_csv_data)
+    return csv_data, mpn_csv_data
+
+
+def get_shop_report_rows(shop_quantities: ShopQuantities, per_shop: bool = True,
+                         velocity: SalesVelocity = None) -> Dict[int, Callable[[], Iterator[List]]]:
+    """
+    Report rows of the items in stock in each shop, and across all shops under ALL_SHOPS
+    :param per_shop: False gives only the all-shops rows
+    :param velocity: adds sales velocity columns to each row
+    :return: shop id to a function returning the shop's rows
+    """
+    logging.info(f"Formatting report rows for {len(shop_quantities.shop_ids) if per_shop else 0} shops and all shops")
+    items = shop_quantities.items
+
+    def shop_rows(quantities: np.ndarray) -> Iterator[List]:
+        # Each row is formatted as it is written, so memory doesn't grow with the catalog.
+        for index in np.flatnonzero(quantities > 0).tolist():
+            row = get_report_row(items[index], int(quantities[index]))
+            yield row + velocity.row(row[0]) if velocity else row
+
+    shop_ids = [ALL_SHOPS] + (shop_quantities.shop_ids if per_shop else [])
+    return dict([(shop_id, functools.partial(shop_rows, shop_quantities.quantities(shop_id)))
+                 for shop_id in shop_ids])
+
+
+FEED_FORMATS = ['csv', 'gzip', 'parquet']
+
+
+def delta_uri(s3_uri: str) -> str:
+    """
+    s3://bucket/inventory.csv -> s3://bucket/inventory.delta.csv
+    """
+    root, extension = posixpath.splitext(s3_uri)
+    return f"{root}.delta{extension}"
+
+
+def feed_uri(s3_uri: str, feed_format: str) -> str:
+    """
+    Uri of a csv feed in another format, gzip adds .gz and parquet replaces the extension
+    """
+    if feed_format == 'gzip':
+        return f"{s3_uri}.gz"
+    if feed_format == 'parquet':
+        return f"{posixpath.splitext(s3_uri)[0]}.parquet"
+    return s3_uri
+
+
+def encode_feed(csv_data: bytes, feed_format: str) -> bytes:
+    if feed_format == 'gzip':
+        # No timestamp in the header, so unchanged feeds compress to the same bytes and skip the upload.
+        return gzip.compress(csv_data, mtime=0)
+    if feed_format == 'parquet':
+        # pandas is only needed for parquet feeds. Columns stay the display formatted strings of the csv.
+        import pandas
+
+        df = pandas.read_csv(io.BytesIO(csv_data), dtype=str, keep_default_na=False)
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+        return buffer.getvalue()
+    return csv_data
+
+
+def upload_feed(csv_data: bytes, s3_uri: str, feed_format: str = 'csv') -> bool:
+    """
+    :param s3_uri: uri of the csv feed, see feed_uri
+    """
+    return upload_to_s3(encode_feed(csv_data, feed_format), feed_uri(s3_uri, feed_format))
+
+
+@functools.lru_cache(maxsize=None)
+def get_s3_client():
+    # boto3 clients are thread safe, one is shared by every upload.
     aws_config = ReserConfig.get_config()['aws']
-    logging.info(f"Uploading {csv_file} to S3 {s3_csv_uri}")
-    # Upload to s3
-    client = boto3.client(
+    return boto3.client(
         's3',
         aws_access_key_id=aws_config['access_key_id'],
         aws_secret_access_key=aws_config['access_key_secret']
     )
-    upload_csv_file(client, csv_file, s3_csv_uri)
-    logging.info("File uploaded")
 
 
-def upload_csv_file(client, csv_file, aws_file):
-    split_url = urllib.parse.urlsplit(aws_file)
-    with open(csv_file, "rb") as f:
-        client.upload_fileobj(f, f"{split_url.netloc}", f"{split_url.path[1:]}")
\ No newline at end of file
+@functools.lru_cache(maxsize=None)
+def get_upload_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='S3Upload')
+
+
+def wait_for_uploads(uploads: Iterable[Future]) -> None:
+    """
+    Wait for every upload, then raise the first error if any failed
+    """
+    errors = [upload.exception() for upload in list(uploads)]
+    errors = [error for error in errors if error is not None]
+    if errors:
+        raise errors[0]
+
+
+def s3_checksum(data: bytes) -> str:
+    """
+    Base64 SHA-256, the form S3 stores as the object's ChecksumSHA256
+    """
+    return base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+
+
+def get_s3_object_checksum(client, bucket: str, key: str) -> Optional[str]:
+    try:
+        return client.head_object(Bucket=bucket, Key=key, ChecksumMode='ENABLED').get('ChecksumSHA256')
+    except botocore.exceptions.ClientError as err:
+        if err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def upload_to_s3(data: bytes, s3_uri: str) -> bool:
+    """
+    Upload from memory, unless the object already has the same contents
+    :param data: file contents
+    :param s3_uri: s3://bucket/key
+    :return: False if the upload was skipped
+    """
+    split_url = urllib.parse.urlsplit(s3_uri)
+    bucket, key = f"{split_url.netloc}", f"{split_url.path[1:]}"
+    with span('s3.upload', s3_uri, bytes=len(data)) as span_data:
+        client = get_s3_client()
+        checksum = s3_checksum(data)
+        span_data['skipped'] = get_s3_object_checksum(client, bucket, key) == checksum
+        if span_data['skipped']:
+            logging.info(f"Skipping upload to S3 {s3_uri}, contents unchanged")
+            return False
+        logging.info(f"Uploading {len(data)} bytes to S3 {s3_uri}")
+        client.put_object(Bucket=bucket, Key=key, Body=data, ChecksumSHA256=checksum)
+    logging.info("File uploaded")
+    return True
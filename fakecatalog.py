@@ -0,0 +1,106 @@
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+# Every Lightspeed catalog has the shopID 0 ItemShop, the item's totals across shops.
+ALL_SHOPS = 0
+
+
+class FakeCatalog:
+    """
+    Lightspeed shaped Item and Sale json, as get_records returns them, for a catalog of any size.
+    Values are strings like Lightspeed's and the shapes vary the way Lightspeed's do: a lone ItemShop or SaleLine
+    comes as an object instead of a list, and some items have no UPC, MPN or price.
+    The same seed always gives the same catalog.
+    """
+
+    def __init__(self, item_count: int, shop_count: int = 3, seed: int = 0):
+        """
+        :param item_count: number of items
+        :param shop_count: shops besides the all-shops total
+        """
+        self.item_count = item_count
+        self.shop_count = shop_count
+        self.seed = seed
+        self.now = datetime(2023, 6, 1, 12, 0, tzinfo=timezone.utc)
+
+    def items(self) -> List[Dict]:
+        return [self.create_item_json(item_id, self.item_random(item_id)) for item_id in range(1, self.item_count + 1)]
+
+    def item_random(self, item_id: int) -> random.Random:
+        # Seeded per item, so an item in a sale line is the same as in the catalog.
+        return random.Random(self.seed * 1000003 + item_id)
+
+    def sales(self, sale_count: int, num_days: int = 90) -> List[Dict]:
+        """
+        Completed sales spread over the num_days before now, with SaleLines.Item loaded
+        :param sale_count: number of sales, each with 1 to 4 lines
+        """
+        rng = random.Random(self.seed + 1)
+        sales = []
+        sale_line_id = 0
+        for sale_id in range(1, sale_count + 1):
+            complete_time = self.now - timedelta(seconds=rng.randrange(num_days * 86400))
+            lines = []
+            for _ in range(rng.choice([1, 1, 2, 3, 4])):
+                sale_line_id += 1
+                lines.append(self.create_sale_line_json(sale_line_id, sale_id, rng.randint(1, self.item_count), rng))
+            sales.append({'saleID': str(sale_id),
+                          'completed': 'true',
+                          'completeTime': complete_time.isoformat(),
+                          'employeeID': str(rng.randint(1, 10)),
+                          'shopID': str(rng.randint(1, max(1, self.shop_count))),
+                          'calcSubtotal': '%.2f' % sum([float(line['calcSubtotal']) for line in lines]),
+                          'timeStamp': complete_time.isoformat(),
+                          'SaleLines': {'SaleLine': lines if len(lines) > 1 else lines[0]}})
+        return sales
+
+    def create_item_json(self, item_id: int, rng: random.Random) -> Dict:
+        cost = round(rng.uniform(1, 400), 2)
+        item = {'itemID': str(item_id),
+                'systemSku': str(210000000000 + item_id),
+                'defaultCost': '%.2f' % cost,
+                'avgCost': '%.2f' % round(cost * rng.uniform(0.9, 1.1), 2),
+                'description': f'Synthetic part {item_id} {rng.choice(["Black", "Red", "Blue", "Silver"])}',
+                'upc': str(rng.randrange(10 ** 11, 10 ** 12)) if rng.random() < 0.8 else '',
+                'ean': '',
+                'customSku': f'C{item_id}' if rng.random() < 0.3 else '',
+                'manufacturerSku': f'MPN-{item_id}' if rng.random() < 0.7 else '',
+                'timeStamp': (self.now - timedelta(minutes=item_id)).isoformat(),
+                'ItemShops': {'ItemShop': self.create_item_shops_json(item_id, rng)}}
+        if rng.random() < 0.95:
+            prices = [{'amount': '%.2f' % round(cost * rng.uniform(1.2, 2.0), 2), 'useTypeID': '1',
+                       'useType': 'Default'},
+                      {'amount': '%.2f' % round(cost * 1.1, 2), 'useTypeID': '2', 'useType': 'MSRP'}]
+            item['Prices'] = {'ItemPrice': prices}
+        return item
+
+    def create_item_shops_json(self, item_id: int, rng: random.Random):
+        """
+        :return: the all-shops ItemShop and one per shop, or for a quarter of the items the all-shops ItemShop alone,
+            the lone record shape
+        """
+        quantities = [max(0, rng.randint(-3, 6)) for _ in range(self.shop_count)]
+        total = self.create_item_shop_json(item_id, ALL_SHOPS, sum(quantities))
+        if self.shop_count <= 1 or rng.random() < 0.25:
+            return total
+        return [total] + [self.create_item_shop_json(item_id, shop_id, quantity)
+                          for shop_id, quantity in enumerate(quantities, start=1)]
+
+    def create_item_shop_json(self, item_id: int, shop_id: int, quantity: int) -> Dict:
+        return {'itemShopID': str(item_id * 100 + shop_id),
+                'itemID': str(item_id),
+                'shopID': str(shop_id),
+                'qoh': str(quantity),
+                'timeStamp': self.now.isoformat()}
+
+    def create_sale_line_json(self, sale_line_id: int, sale_id: int, item_id: int, rng: random.Random) -> Dict:
+        units = rng.choice([1, 1, 1, 2, 3])
+        unit_price = round(rng.uniform(5, 500), 2)
+        return {'saleLineID': str(sale_line_id),
+                'saleID': str(sale_id),
+                'itemID': str(item_id),
+                'unitQuantity': str(units),
+                'unitPrice': '%.2f' % unit_price,
+                'calcSubtotal': '%.2f' % (unit_price * units),
+                'Item': self.create_item_json(item_id, self.item_random(item_id))}
@@ -0,0 +1,207 @@
+import json
+import random
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Tuple
+from xml.sax.saxutils import escape
+
+
+class FakeServer:
+    """
+    Local stand-in for a remote API, served from a background thread.
+    Every request can be delayed, throttled with a 429 or failed with a 500.
+    """
+
+    def __init__(self, latency: float = 0.0, rate_limit_rate: float = 0.0, failure_rate: float = 0.0,
+                 seed: int = 0):
+        """
+        :param latency: seconds added to every response
+        :param rate_limit_rate: fraction of requests answered with 429 Too Many Requests
+        :param failure_rate: fraction of requests answered with 500 Internal Server Error
+        :param seed: random seed, so runs are repeatable
+        """
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.failure_rate = failure_rate
+        self.request_count = 0
+        self.status_counts: Dict[int, int] = dict()
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), self.__create_handler())
+        self.__server.daemon_threads = True
+        self.__thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self) -> 'FakeServer':
+        self.__thread = threading.Thread(target=self.__server.serve_forever, name=type(self).__name__, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        """
+        Answer one request
+        :return: status code, content type and body
+        """
+        raise NotImplementedError
+
+    def _respond(self, handler: BaseHTTPRequestHandler, method: str) -> None:
+        split_url = urllib.parse.urlsplit(handler.path)
+        query = dict(urllib.parse.parse_qsl(split_url.query))
+        body = handler.rfile.read(int(handler.headers.get('Content-Length') or 0))
+        with self.__lock:
+            self.request_count += 1
+            roll = self.__random.random()
+        if self.latency:
+            time.sleep(self.latency)
+
+        headers = dict()
+        if roll < self.rate_limit_rate:
+            status, content_type, content = 429, 'text/plain', b'Too Many Requests'
+            headers['Retry-After'] = '0'
+        elif roll < self.rate_limit_rate + self.failure_rate:
+            status, content_type, content = 500, 'text/plain', b'Internal Server Error'
+        else:
+            status, content_type, content = self.handle(method, split_url.path, query, body)
+        with self.__lock:
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(content)
+
+    def __create_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server._respond(self, 'GET')
+
+            def do_POST(self):
+                server._respond(self, 'POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakeSmartetailingServer(FakeServer):
+    """
+    Smartetailing order export with synthetic orders.
+    Every fifth order is an in-store pickup and every seventh is already shipped, so the Shippo filters have work.
+    """
+
+    def __init__(self, order_count: int, first_order_id: int = 100000, **kwargs):
+        super().__init__(**kwargs)
+        self.order_ids = [str(first_order_id + ij) for ij in range(order_count)]
+        # Build the export up front, it never changes and shouldn't count against the client's memory.
+        self.__export_xml = create_order_export_xml(self.order_ids).encode('utf-8')
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if query.get('method') == 'Orders':
+            return 200, 'text/xml', self.__export_xml
+        # UpdateOrder / UpdateStatus
+        return 200, 'text/xml', b'<Response>OK</Response>'
+
+
+class FakeShippoServer(FakeServer):
+    """
+    Shippo orders endpoint, newest first, with optional orders already in the account.
+    """
+
+    def __init__(self, existing_order_numbers: List[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.__orders_lock = threading.Lock()
+        self.__created_time = datetime(2023, 1, 1)
+        self.orders: List[dict] = []
+        for order_number in existing_order_numbers or []:
+            self.__add_order(order_number)
+
+    @property
+    def created_order_count(self) -> int:
+        return self.status_counts.get(201, 0)
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if method == 'POST':
+            order_json = json.loads(body)
+            return 201, 'application/json', json.dumps(self.__add_order(order_json['order_number'])).encode('utf-8')
+
+        page_size = int(query.get('results', 25))
+        page = int(query.get('page', 1))
+        with self.__orders_lock:
+            newest_first = self.orders[::-1][(page - 1) * page_size:page * page_size]
+        return 200, 'application/json', json.dumps({'results': newest_first}).encode('utf-8')
+
+    def __add_order(self, order_number: str) -> dict:
+        with self.__orders_lock:
+            self.__created_time += timedelta(seconds=1)
+            order = {'object_id': f"{len(self.orders):032x}",
+                     'object_created': self.__created_time.isoformat() + 'Z',
+                     'order_number': order_number}
+            self.orders.append(order)
+        return order
+
+
+def create_order_export_xml(order_ids: List[str]) -> str:
+    orders = [create_web_order_xml(order_id, ij) for ij, order_id in enumerate(order_ids)]
+    return f"<?xml version=\"1.0\" encoding=\"UTF-8\"?><XMLOrders>{''.join(orders)}</XMLOrders>"
+
+
+def create_web_order_xml(order_id: str, index: int) -> str:
+    classification = 'Store Pickup' if index % 5 == 0 else 'Ground'
+    status = 'Shipped' if index % 7 == 0 else 'Processing'
+    address = create_address_xml(f"Customer {order_id}")
+    items = ''.join(create_item_xml(index * 10 + line) for line in range(1 + index % 3))
+    return f"""<WebOrder><Order>
+<Currency>USD</Currency><OrderId>{order_id}</OrderId><Time>Mon Jan 02 10:00:00 2023</Time>
+<CustomerId>{index}</CustomerId><CustomerIP>127.0.0.1</CustomerIP>
+<AddressShipTo>{address}</AddressShipTo><AddressBillTo>{address}</AddressBillTo>
+<AffiliateInfo><Id>0</Id><Affiliate>None</Affiliate><Commission>0</Commission></AffiliateInfo>
+<Shipping><Method>UPS Ground</Method><Classification>{classification}</Classification><PickupLocation/></Shipping>
+<PaymentInfo><PaymentMethod>Credit Card</PaymentMethod><CreditCardInfo>
+<CreditCard><CCV/><Expiration>01/30</Expiration><Type>Visa</Type><Number>XXXX1111</Number></CreditCard>
+<CardAuthInfo><Amount>100.00</Amount><Auth-Response>A</Auth-Response><AVS-Response>Y</AVS-Response>
+<CCV-Response>M</CCV-Response><TransId>{index}</TransId></CardAuthInfo>
+</CreditCardInfo></PaymentInfo>
+<Status>{status}</Status><Comments/>
+<Items>{items}</Items>
+<OrderTotal><Line type="Subtotal">90.00</Line><Line type="Discount">0.00</Line><Line type="Shipping">5.00</Line>
+<Line type="Tax">5.00</Line><Line type="Total">100.00</Line></OrderTotal>
+</Order><WebComment/></WebOrder>"""
+
+
+def create_address_xml(full_name: str) -> str:
+    first, last = full_name.split(' ', 1)
+    return f"""<Name><First>{escape(first)}</First><Last>{escape(last)}</Last><Full>{escape(full_name)}</Full></Name>
+<Address1>100 Main St</Address1><Address2/><City>Newport</City><State>KY</State><Country>US</Country>
+<Zip>41071</Zip><Phone>859-555-0100</Phone><Email>customer@example.com</Email>"""
+
+
+def create_item_xml(item_id: int) -> str:
+    return f"""<Item><Id>{item_id}</Id><Code>{item_id}</Code><Mpn>MPN-{item_id}</Mpn><Gtin1/><Gtin2/>
+<Quantity>1</Quantity><Unit-Price>30.00</Unit-Price><Weight>2.5</Weight><Description>Part {item_id}</Description>
+<Category>Parts</Category><Url/><Taxable>YES</Taxable><ModelYear/></Item>"""
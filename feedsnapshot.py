@@ -0,0 +1,70 @@
+import json
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from sqlitestore import SQLiteStore
+
+
+class FeedSnapshot(SQLiteStore):
+    """
+    Last published row of every SKU in each feed, to build delta feeds of what changed since.
+    Rows are staged by delta and only replace the published snapshot on commit, once the uploads went through.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS feed_row (
+            feed TEXT NOT NULL,
+            system_sku TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            row_json TEXT NOT NULL,
+            PRIMARY KEY (feed, system_sku));
+    """
+
+    def __init__(self, db_file: str, sku_index: int, remaining_index: int, compare_indexes: List[int]):
+        """
+        :param sku_index: row index of the SKU
+        :param remaining_index: row index of the quantity, zeroed for SKUs that left the feed
+        :param compare_indexes: row indexes that make a change, e.g. quantity, price and cost
+        """
+        super().__init__(db_file)
+        self.sku_index = sku_index
+        self.remaining_index = remaining_index
+        self.compare_indexes = compare_indexes
+        self.__staged: Dict[str, Dict[str, Tuple[str, List]]] = dict()
+
+    def delta(self, feed: str, rows: Iterable[List]) -> Iterator[List]:
+        """
+        Rows that are new or changed since the feed was last published, followed by the last published
+        rows of SKUs no longer in the feed with no quantity remaining.
+        :param feed: feed name, e.g. its uri
+        """
+        with closing(self.connect()) as db:
+            published = dict([(system_sku, fingerprint) for system_sku, fingerprint in db.execute(
+                "SELECT system_sku, fingerprint FROM feed_row WHERE feed = ?", (feed,))])
+        staged: Dict[str, Tuple[str, List]] = dict()
+        for row in rows:
+            fingerprint = json.dumps([row[index] for index in self.compare_indexes])
+            system_sku = row[self.sku_index]
+            staged[system_sku] = (fingerprint, list(row))
+            if published.get(system_sku) != fingerprint:
+                yield row
+        removed = [system_sku for system_sku in published if system_sku not in staged]
+        with closing(self.connect()) as db:
+            for system_sku in removed:
+                row_json, = db.execute("SELECT row_json FROM feed_row WHERE feed = ? AND system_sku = ?",
+                                       (feed, system_sku)).fetchone()
+                row = json.loads(row_json)
+                row[self.remaining_index] = 0
+                yield row
+        self.__staged[feed] = staged
+
+    def commit(self) -> None:
+        """
+        Publish the rows staged by delta
+        """
+        with closing(self.connect()) as db, db:
+            for feed, staged in self.__staged.items():
+                db.execute("DELETE FROM feed_row WHERE feed = ?", (feed,))
+                db.executemany("INSERT INTO feed_row (feed, system_sku, fingerprint, row_json) VALUES (?, ?, ?, ?)",
+                               [(feed, system_sku, fingerprint, json.dumps(row))
+                                for system_sku, (fingerprint, row) in staged.items()])
+        self.__staged.clear()
@@ -1,7 +1,205 @@
+import hashlib
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar, Union
+
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from responsecache import ResponseCache
+from runreport import submit_in_context
+
+T = TypeVar('T')
+R = TypeVar('R')
 
 
 class HttpConnectionBase:
+    # (connect, read) seconds
+    DEFAULT_TIMEOUT: Tuple[float, float] = (10, 60)
+    DEFAULT_MAX_WORKERS = 4
+    # Throttled or transient server errors worth another attempt
+    RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+    # A throttled request was never handled, so even a POST can be sent again
+    NOT_HANDLED_STATUS_CODES = {429}
+    DEFAULT_MAX_RETRIES = 5
+    # Seconds, doubled for every attempt
+    RETRY_BACKOFF = 1.0
+    MAX_RETRY_DELAY = 60.0
+    # Seconds a GET of each resource is served from the response cache, resources not listed aren't cached
+    CACHE_TTLS: Dict[str, float] = dict()
+
+    def __init__(self, timeout: Union[float, Tuple[float, float]] = None, max_workers: int = None,
+                 max_retries: int = None, response_cache: ResponseCache = None, cache_ttls: Dict[str, float] = None):
+        """
+        :param timeout: request timeout in seconds, or a (connect, read) tuple
+        :param max_workers: number of concurrent requests, also the keep-alive pool size
+        :param max_retries: retries for throttled or failed requests
+        :param response_cache: on-disk cache of GET responses, none if None
+        :param cache_ttls: resource to TTL in seconds, overriding CACHE_TTLS
+        """
+        self.timeout = timeout or HttpConnectionBase.DEFAULT_TIMEOUT
+        self.max_workers = max_workers or HttpConnectionBase.DEFAULT_MAX_WORKERS
+        self.max_retries = HttpConnectionBase.DEFAULT_MAX_RETRIES if max_retries is None else max_retries
+        self.response_cache = response_cache
+        self.cache_ttls = {**type(self).CACHE_TTLS, **(cache_ttls or {})}
+        # Separates the cached responses of different accounts whose URLs are the same
+        self.cache_scope = ''
+        self.__session: Optional[requests.Session] = None
+        self.__executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def session(self) -> requests.Session:
+        if self.__session is None:
+            self.__session = requests.Session()
+            # Keep one connection alive per worker, so concurrent requests reuse TCP+TLS connections.
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            self.__session.mount('https://', adapter)
+            self.__session.mount('http://', adapter)
+        return self.__session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self.__executor is None:
+            self.__executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                 thread_name_prefix=type(self).__name__)
+        return self.__executor
+
+    def close(self) -> None:
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
+        if self.__session is not None:
+            self.__session.close()
+            self.__session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def _request_with_retry(self, method: str, url: str, max_retries: int = None, idempotent: bool = True,
+                            **kwargs) -> requests.Response:
+        """
+        Make a request, retrying throttled (429) and transient 5xx responses and failed connections.
+        Waits for the Retry-After header when the server sends one, otherwise backs off exponentially with jitter.
+        :param max_retries: retries after the first attempt
+        :param idempotent: False for a request that mustn't run twice, e.g. a create. It is then only retried
+            when the server can't have acted on it, a 429 or a connection that failed before the request was sent.
+        :return: the last response, which may still be an error once the retries run out
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        retry_status_codes = HttpConnectionBase.RETRY_STATUS_CODES if idempotent \
+            else HttpConnectionBase.NOT_HANDLED_STATUS_CODES
+        attempt = 0
+        while True:
+            try:
+                response = self._request(method, url, **kwargs)
+                if response.status_code not in retry_status_codes or attempt >= max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                logging.warning(f"{method} {url} returned {response.status_code}, retry {attempt + 1} in {delay:.1f} sec")
+            except requests.ConnectionError as err:
+                if attempt >= max_retries or not (idempotent or self._not_sent(err)):
+                    raise
+                delay = self._retry_delay(attempt)
+                logging.warning(f"{method} {url} failed ({err}), retry {attempt + 1} in {delay:.1f} sec")
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def _not_sent(err: requests.ConnectionError) -> bool:
+        """
+        True if the connection failed before any of the request was sent, e.g. refused or timed out connecting
+        """
+        if isinstance(err, requests.exceptions.ConnectTimeout):
+            return True
+        reason = err.args[0] if err.args else None
+        # requests wraps urllib3's MaxRetryError, whose reason is the underlying error.
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+    @staticmethod
+    def _retry_delay(attempt: int, response: requests.Response = None) -> float:
+        """
+        Seconds to wait before the next attempt
+        :param attempt: number of attempts already retried
+        :param response: failed response, checked for a Retry-After header
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return max(0.0, float(retry_after))
+            except ValueError:
+                try:
+                    retry_time = parsedate_to_datetime(retry_after)
+                    return max(0.0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+                except (TypeError, ValueError):
+                    pass
+        # Full jitter, so concurrent workers don't all retry at the same moment.
+        backoff = min(HttpConnectionBase.MAX_RETRY_DELAY, HttpConnectionBase.RETRY_BACKOFF * 2 ** attempt)
+        return random.uniform(0, backoff)
+
+    def _get(self, url: str, cache_resource: str = None, **kwargs) -> requests.Response:
+        """
+        :param cache_resource: resource the response is cached as, when the response cache has a TTL for it
+        """
+        ttl = self.cache_ttls.get(cache_resource) if self.response_cache and cache_resource else None
+        if not ttl:
+            return self._request_with_retry('GET', url, **kwargs)
+        return self.__get_cached(url, cache_resource, ttl, **kwargs)
+
+    def __get_cached(self, url: str, resource: str, ttl: float, **kwargs) -> requests.Response:
+        """
+        Serve a GET from the response cache while it is younger than ttl. Once it is older, revalidate it with
+        If-None-Match/If-Modified-Since when the server sent an ETag or Last-Modified, and only download it again
+        if it changed.
+        """
+        cache = self.response_cache
+        prepared_url = requests.Request('GET', url, params=kwargs.pop('params', None)).prepare().url
+        key = hashlib.sha256(f'{self.cache_scope} {prepared_url}'.encode('utf-8')).hexdigest()
+        cached = cache.get(key)
+        if cached and cached.age() < ttl:
+            cache.count('hits')
+            return cached.to_response()
+        validators = cached.validators() if cached else {}
+        if validators:
+            kwargs['headers'] = {**kwargs.get('headers', {}), **validators}
+        response = self._request_with_retry('GET', prepared_url, **kwargs)
+        if response.status_code == 304 and cached:
+            logging.debug(f"{resource} response unchanged, {prepared_url}")
+            cache.touch(key)
+            cache.count('revalidated')
+            return cached.to_response()
+        cache.count('misses')
+        if response.status_code == 200:
+            cache.put(key, resource, response)
+        return response
+
+    def _post(self, url: str, **kwargs) -> requests.Response:
+        # POSTs create things, so one the server may have acted on is never sent again.
+        return self._request_with_retry('POST', url, idempotent=False, **kwargs)
+
+    def _map_concurrent(self, func: Callable[[T], R], items: Iterable[T]) -> List[R]:
+        """
+        Call func for each item on the worker pool
+        :param func: function to call, typically one HTTP request
+        :param items: arguments for each call
+        :return: results, in the same order as items
+        """
+        futures = [submit_in_context(self.executor, func, item) for item in items]
+        return [future.result() for future in futures]
+
     @staticmethod
     def _handle_response(response: requests.Response) -> None:
         if response.status_code >= 300:
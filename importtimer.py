@@ -0,0 +1,81 @@
+import builtins
+import importlib.util
+import logging
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+
+class ImportTimer:
+    """
+    Records how long each import statement spends loading new modules, like python -X importtime.
+    Self time excludes the nested imports, cumulative time includes them.
+    """
+
+    def __init__(self):
+        self.timings: Dict[str, Tuple[float, float]] = dict()
+        self.start_time = time.perf_counter()
+        self.__original_import = builtins.__import__
+        self.__local = threading.local()
+
+    def start(self) -> 'ImportTimer':
+        self.start_time = time.perf_counter()
+        builtins.__import__ = self.__timed_import
+        return self
+
+    def stop(self) -> None:
+        builtins.__import__ = self.__original_import
+
+    @property
+    def total_import_time(self) -> float:
+        # Self times add up to the total without counting nested imports twice.
+        return sum(self_time for self_time, _ in self.timings.values())
+
+    def report(self, command: str, top: int = 20) -> str:
+        elapsed = time.perf_counter() - self.start_time
+        lines = [f"Import report for {command}: {len(self.timings)} imports took "
+                 f"{self.total_import_time * 1000:.0f} ms of the {elapsed * 1000:.0f} ms run",
+                 f"{'self ms':>9} {'cumulative ms':>14} module"]
+        slowest: List[Tuple[str, Tuple[float, float]]] = sorted(self.timings.items(), key=lambda x: x[1][1],
+                                                                reverse=True)
+        for name, (self_time, cumulative_time) in slowest[:top]:
+            lines.append(f"{self_time * 1000:>9.1f} {cumulative_time * 1000:>14.1f} {name}")
+        return '\n'.join(lines)
+
+    def __timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Already loaded, nothing to time.
+        if level == 0 and name in sys.modules and not fromlist:
+            return self.__original_import(name, globals, locals, fromlist, level)
+
+        module_name = self.__resolve_name(name, globals, level)
+        # [module name, seconds spent in nested imports]
+        stack: List[list] = self.__local.__dict__.setdefault('stack', [])
+        module_count = len(sys.modules)
+        stack.append([module_name, 0.0])
+        start = time.perf_counter()
+        try:
+            return self.__original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            _, nested_time = stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            if len(sys.modules) > module_count:
+                # A package importing its own names re-enters here, only the outermost call counts as cumulative.
+                reentrant = any(module_name == active_name for active_name, _ in stack)
+                previous_self, previous_cumulative = self.timings.get(module_name, (0.0, 0.0))
+                self.timings[module_name] = (previous_self + elapsed - nested_time,
+                                             previous_cumulative + (0.0 if reentrant else elapsed))
+
+    @staticmethod
+    def __resolve_name(name: str, globals: dict, level: int) -> str:
+        if level == 0:
+            return name
+        try:
+            return importlib.util.resolve_name('.' * level + name, (globals or {}).get('__package__'))
+        except (ImportError, ValueError):
+            return name
+
+    def log_report(self, command: str) -> None:
+        logging.info(self.report(command))
@@ -0,0 +1,188 @@
+import json
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlitestore import SQLiteStore
+
+
+def item_shops(item: Dict) -> List[Dict]:
+    """
+    ItemShop records of an item, Lightspeed returns a lone ItemShop as an object instead of a list.
+    """
+    try:
+        shops = item['ItemShops']['ItemShop']
+    except (KeyError, TypeError):
+        return []
+    return shops if isinstance(shops, list) else [shops]
+
+
+class InventoryStore(SQLiteStore):
+    """
+    Local SQLite snapshot of Lightspeed items and their per-shop quantities.
+    Items are stored without their ItemShops, which live in their own table so quantity changes
+    can be applied without re-downloading the item.
+    """
+    FULL_SYNC = 'inventory_full_sync'
+    ITEM_TIMESTAMP = 'item_timestamp'
+    ITEM_SHOP_TIMESTAMP = 'item_shop_timestamp'
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS item (
+            item_id INTEGER PRIMARY KEY,
+            system_sku TEXT,
+            time_stamp TEXT,
+            item_json TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS item_shop (
+            item_shop_id INTEGER PRIMARY KEY,
+            item_id INTEGER NOT NULL,
+            shop_id INTEGER NOT NULL,
+            qoh INTEGER NOT NULL,
+            time_stamp TEXT,
+            item_shop_json TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS item_shop_item ON item_shop (item_id, shop_id);
+    """
+
+    def __init__(self, db_file: str):
+        super().__init__(db_file)
+        self.__drop_shop_positions()
+
+    def __drop_shop_positions(self) -> None:
+        # Older stores kept the order ItemShops arrived in. Nothing reads it since the feeds look shops up by
+        # shopID, so such a table is dropped and the next sync is a full one that fills it again.
+        with closing(self.connect()) as db, db:
+            columns = [row[1] for row in db.execute("PRAGMA table_info(item_shop)")]
+            if 'position' not in columns:
+                return
+            db.execute("DROP TABLE item_shop")
+            db.execute("DELETE FROM sync_state WHERE key = ?", (InventoryStore.FULL_SYNC,))
+            db.executescript(InventoryStore.SCHEMA)
+
+    def get_state(self, key: str) -> Optional[str]:
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def needs_full_sync(self, full_sync_days: float) -> bool:
+        last_full_sync = self.get_state(InventoryStore.FULL_SYNC)
+        return not last_full_sync or \
+            datetime.now() - datetime.fromisoformat(last_full_sync) > timedelta(days=full_sync_days)
+
+    def replace_items(self, items: Iterable[Dict]) -> int:
+        """
+        Replace the whole snapshot, e.g. for the periodic full reconcile
+        :param items: every in-stock item with its ItemShops
+        :return: number of items stored
+        """
+        sync_time = datetime.now()
+        item_rows, shops = self.__item_rows(items)
+        with closing(self.connect()) as db, db:
+            db.execute("DELETE FROM item")
+            db.execute("DELETE FROM item_shop")
+            db.execute("DELETE FROM sync_state WHERE key IN (?, ?)",
+                       (InventoryStore.ITEM_TIMESTAMP, InventoryStore.ITEM_SHOP_TIMESTAMP))
+            self.__upsert_items(db, item_rows, shops)
+            self.__set_state(db, InventoryStore.FULL_SYNC, sync_time.isoformat())
+        return len(item_rows)
+
+    def upsert_items(self, items: Iterable[Dict]) -> int:
+        """
+        :param items: changed items with their ItemShops
+        :return: number of items stored
+        """
+        item_rows, shops = self.__item_rows(items)
+        with closing(self.connect()) as db, db:
+            self.__upsert_items(db, item_rows, shops)
+        return len(item_rows)
+
+    def upsert_item_shops(self, shops: Iterable[Dict]) -> int:
+        """
+        :param shops: changed ItemShop records
+        :return: number of ItemShops stored
+        """
+        shops = list(shops)
+        with closing(self.connect()) as db, db:
+            return self.__upsert_item_shops(db, shops)
+
+    def missing_item_ids(self) -> List[int]:
+        """
+        Items with stocked shops but no item record, e.g. an item that was out of stock at the last full sync
+        """
+        with closing(self.connect()) as db:
+            rows = db.execute("""
+                SELECT DISTINCT item_id FROM item_shop
+                WHERE qoh > 0 AND NOT EXISTS (SELECT 1 FROM item WHERE item.item_id = item_shop.item_id)
+                ORDER BY item_id""").fetchall()
+        return [row[0] for row in rows]
+
+    def in_stock_items(self) -> Iterator[Dict]:
+        """
+        Items with stock in any shop, rebuilt in the shape Lightspeed returns them with ItemShops loaded
+        """
+        with closing(self.connect()) as db:
+            item_rows = db.execute("""
+                SELECT item.item_id, item.item_json FROM item
+                WHERE EXISTS (SELECT 1 FROM item_shop WHERE item_shop.item_id = item.item_id AND qoh > 0)
+                ORDER BY item.item_id""")
+            shop_rows = db.execute("""
+                SELECT item_shop.item_id, item_shop.item_shop_json FROM item_shop
+                WHERE EXISTS (SELECT 1 FROM item_shop stocked WHERE stocked.item_id = item_shop.item_id AND stocked.qoh > 0)
+                ORDER BY item_shop.item_id, item_shop.shop_id""")
+            # Walk both cursors in item order instead of querying the shops of every item.
+            shop_row = next(shop_rows, None)
+            for item_id, item_json in item_rows:
+                item = json.loads(item_json)
+                shops = []
+                while shop_row is not None and shop_row[0] <= item_id:
+                    if shop_row[0] == item_id:
+                        shops.append(json.loads(shop_row[1]))
+                    shop_row = next(shop_rows, None)
+                item['ItemShops'] = {'ItemShop': shops}
+                yield item
+
+    @staticmethod
+    def __item_rows(items: Iterable[Dict]) -> Tuple[List[Tuple], List[Dict]]:
+        """
+        Item rows and ItemShops of the downloaded items, read in full before the write transaction opens
+        """
+        item_rows, shops = [], []
+        for item in items:
+            shops.extend(item_shops(item))
+            item_data = dict([(key, value) for key, value in item.items() if key != 'ItemShops'])
+            item_rows.append((int(item['itemID']), item.get('systemSku'), item.get('timeStamp'),
+                              json.dumps(item_data)))
+        return item_rows, shops
+
+    def __upsert_items(self, db: sqlite3.Connection, item_rows: List[Tuple], shops: List[Dict]) -> None:
+        db.executemany("INSERT OR REPLACE INTO item (item_id, system_sku, time_stamp, item_json) VALUES (?, ?, ?, ?)",
+                       item_rows)
+        newest_item = max([self.__get_state(db, InventoryStore.ITEM_TIMESTAMP) or ''] +
+                          [time_stamp or '' for _, _, time_stamp, _ in item_rows]) or None
+        self.__upsert_item_shops(db, shops)
+        if newest_item:
+            self.__set_state(db, InventoryStore.ITEM_TIMESTAMP, newest_item)
+
+    def __upsert_item_shops(self, db: sqlite3.Connection, shops: Iterable[Dict]) -> int:
+        count = 0
+        newest_shop = self.__get_state(db, InventoryStore.ITEM_SHOP_TIMESTAMP)
+        for shop in shops:
+            db.execute("""
+                INSERT OR REPLACE INTO item_shop (item_shop_id, item_id, shop_id, qoh, time_stamp, item_shop_json)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+                       (int(shop['itemShopID']), int(shop['itemID']), int(shop.get('shopID', 0)),
+                        int(shop.get('qoh', 0)), shop.get('timeStamp'), json.dumps(shop)))
+            newest_shop = max(newest_shop or '', shop.get('timeStamp') or '') or None
+            count += 1
+        if newest_shop:
+            self.__set_state(db, InventoryStore.ITEM_SHOP_TIMESTAMP, newest_shop)
+        return count
+
+    @staticmethod
+    def __get_state(db: sqlite3.Connection, key: str) -> Optional[str]:
+        row = db.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def __set_state(db: sqlite3.Connection, key: str, value: str) -> None:
+        db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
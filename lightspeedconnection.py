@@ -1,15 +1,25 @@
 import logging
 import webbrowser
-from datetime import datetime, timedelta, timezone
-from typing import Dict, List, Tuple, Callable, Any
+import threading
+from collections import deque
+from concurrent.futures import Future
+from datetime import date, datetime, time, timedelta, tzinfo
+from typing import Callable, Dict, List, Tuple, Iterator, Deque, Optional
+from urllib import parse
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-import dateutil.parser
 import lightspeed_api
-import matplotlib.pyplot as plt
 import numpy as np
 
-from datafeed import get_sale_items
 from httpconnection import HttpConnectionBase
+from inventorystore import InventoryStore
+from lightspeedobjects import Item, Sale, Workorder, WorkorderStatus
+from ratelimiter import LeakyBucketLimiter
+from responsecache import ResponseCache
+from runreport import span, submit_in_context
+from salesstore import SalesStore, VELOCITY_DAYS
+from workload import Workload
+from workorderstore import WorkorderStore
 
 
 def assert_http_status(response, status_code, message):
@@ -40,6 +50,9 @@ def plot_workorder_status(counter, employees, statuses):
 
 
 def plot_pmesh(x, y, z, xticks, yticks, xlabel, ylabel):
+    # matplotlib is slow to import and only the schedule plots need it.
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize=(10, 6))
     ax = plt.axes()
     pmesh = ax.pcolormesh(x, y, z, shading='auto')
@@ -54,64 +67,48 @@ def plot_pmesh(x, y, z, xticks, yticks, xlabel, ylabel):
     plt.show()
 
 
-def plot_workorder_allocation(workorders, employees):
-    workorders_by_employee = group_by(workorders, lambda x: int(x['employeeID']))
-    date_ranges, (date_min, date_max) = get_date_ranges(workorders)
-    logging.debug(f'min-date:{date_min.date()} - max-date:{date_max.date()}')
-
-    employee_ids = list(employees.keys())
-    y = np.arange(0, len(employee_ids), 1)
-    x = [(date_min + timedelta(days=ij)).date() for ij in range((date_max - date_min).days)]
-    z = np.zeros((len(y), len(x)))
-    for row, employee_id in enumerate(workorders_by_employee.keys()):
-        for workorder in workorders_by_employee[employee_id]:
-            z[row, :] += date_allocation_array(date_min, date_max, date_range(workorder))
-
-    plot_pmesh(x, y, z, [], list(employees.values()), 'Date', 'Employee')
-    plt.gcf().autofmt_xdate()
-
-
-def date_range(workorder) -> Tuple[datetime, datetime]:
-    return dateutil.parser.parse(workorder['timeIn']), dateutil.parser.parse(workorder['etaOut'])
-
-
-def get_date_ranges(workorders) -> Tuple[List[Tuple[datetime, datetime]], Tuple[datetime, datetime]]:
-    date_ranges = [date_range(workorder) for workorder in workorders]
-    date_min = min([min(x) for x in date_ranges])
-    date_max = max([max(x) for x in date_ranges])
-
-    return date_ranges, (date_min, date_max)
-
-
-def date_allocation_array(date_min: datetime, date_max: datetime, date_range: Tuple[datetime, datetime]):
-    start_date = min(date_range)
-    end_date = max(date_range)
-    assigned_days = np.zeros((date_max - date_min).days)
-    assigned_days[(start_date - date_min).days:(end_date - date_min).days] = 1
-    return assigned_days
-
-
-def group_by(items: List, grouper: Callable) -> Dict[Any, List[Any]]:
-    keys = set(map(grouper, items))
-    groups = dict()
-    for key in keys:
-        groups[key] = [item for item in items if grouper(item) == key]
-
-    return groups
+def page_records(page: Dict, source: str) -> List[Dict]:
+    """
+    Records in one Lightspeed response page, Lightspeed returns a lone record as an object instead of a list.
+    """
+    records = page.get(source, [])
+    return records if isinstance(records, list) else [records]
 
 
 class LightspeedConnection(HttpConnectionBase):
-
-    def __init__(self, cache_file: str, account_id: str, client_id: str, client_secret: str, refresh_token: str):
+    # Lightspeed's maximum page size
+    PAGE_SIZE = 100
+    # Days between full inventory downloads, to catch anything the incremental syncs missed
+    FULL_SYNC_DAYS = 7
+    # Reference data that rarely changes, served from the response cache for a day
+    CACHE_TTLS = {'WorkorderStatus': 86400, 'Employee': 86400, 'Shop': 86400}
+
+    def __init__(self, cache_file: str, account_id: str, client_id: str, client_secret: str, refresh_token: str,
+                 max_workers: int = None, page_size: int = None, full_sync_days: float = None,
+                 response_cache: ResponseCache = None, cache_ttls: Dict[str, float] = None, timezone: str = None):
+        """
+        :param timezone: the account's IANA timezone, e.g. America/New_York, read from its first Shop if None
+        """
+        super().__init__(max_workers=max_workers, response_cache=response_cache, cache_ttls=cache_ttls)
+        self.page_size = page_size or LightspeedConnection.PAGE_SIZE
+        self.full_sync_days = LightspeedConnection.FULL_SYNC_DAYS if full_sync_days is None else full_sync_days
+        self.__inventory_store = None
+        self.__sales_store = None
+        self.__workorder_store = None
         self.cache_file = cache_file
         self.account_id = account_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
         self.lightspeed = lightspeed_api.Lightspeed(self.__lightspeed_config)
+        # Lightspeed's bucket is per account, so every connection to the account shares one limiter.
+        self.rate_limiter = LeakyBucketLimiter.shared(account_id)
+        self.__token_lock = threading.Lock()
 
-        self.__workorder_statuses = None
-        self.__employees = None
+        # Reference data resource to when it was loaded and its id to name map
+        self.__reference_data: Dict[str, Tuple[datetime, Dict[int, str]]] = dict()
+        self.__timezone_name = timezone
+        self.__timezone: Optional[tzinfo] = None
 
     def get_access_token(self):
         print("Opening web link")
@@ -121,63 +118,261 @@ class LightspeedConnection(HttpConnectionBase):
         refresh_token = self.lightspeed.get_authorization_token(temporary_token)
         print(f"Refresh Token:\n{refresh_token}")
 
-    def get_sales(self, start_date: datetime = None) -> List[Dict]:
-        sales = self.lightspeed.get('Sale', {'load_relations': '["SaleLines.Item"]',
-                                             'completeTime': f'>,{start_date.isoformat()}'})['Sale']
-        return sales
-
-    def get_recent_sales(self, num_days: int = 30) -> List[Dict]:
-        logging.info(f"Updating last {num_days} days sale data from lightspeed")
-        start_date = datetime.now() - timedelta(days=num_days)
-        recent_sales = self.get_sales(start_date)
-        return get_sale_items(recent_sales)
-
-    def get_inventory(self) -> List:
-        items = self.lightspeed.get('Item', {'load_relations': '["ItemShops"]',
-                                             'ItemShops.qoh': '>,0'})['Item']
-        return items
-
-    def get_workorder_items(self):
-        # 1 week ago
-        week_ago = datetime.now() - timedelta(days=21)
-        est_time_week_ago = week_ago.replace(tzinfo=timezone(timedelta(hours=-5), name="EST"))
-        workorders = self.lightspeed.get('Workorder', {'timeIn': f'>,{est_time_week_ago.isoformat("T", "seconds")}'})[
-            'Workorder']
+    def get_sales(self, start_date: datetime, end_date: datetime = None) -> Iterator[Sale]:
+        """
+        Sales completed after start_date, and before end_date if given
+        """
+        complete_time = f'><,{start_date.isoformat()},{end_date.isoformat()}' if end_date \
+            else f'>,{start_date.isoformat()}'
+        return map(Sale.from_json,
+                   self.get_records('Sale', {'load_relations': '["SaleLines.Item"]', 'completeTime': complete_time}))
+
+    def get_recent_sales(self, num_days: int = 30) -> Iterator[Item]:
+        """
+        Items sold in the last num_days, from the local sales store
+        """
+        first_day = self.sales_store.today() - timedelta(days=num_days)
+        self.sync_sales(first_day)
+        return map(Item.from_json, self.sales_store.sold_items(first_day))
 
+    @property
+    def sales_store(self) -> SalesStore:
+        if not self.__sales_store:
+            self.__sales_store = SalesStore(self.cache_file, self.timezone)
+        return self.__sales_store
+
+    def sync_sales(self, first_day: date) -> SalesStore:
+        """
+        Fetch the sales of the days since first_day that aren't stored yet, plus today's.
+        The velocity windows are always kept, so a shorter sale history doesn't drop them.
+        """
+        store = self.sales_store
+        today = store.today()
+        first_day = min(first_day, today - timedelta(days=max(VELOCITY_DAYS) - 1))
+        missing_days = store.missing_days(first_day, today)
+        # Fetch each run of consecutive missing days with one query.
+        day_ranges: List[List[date]] = []
+        for day in missing_days:
+            if day_ranges and day_ranges[-1][1] + timedelta(days=1) == day:
+                day_ranges[-1][1] = day
+            else:
+                day_ranges.append([day, day])
+        for range_start, range_end in day_ranges:
+            logging.info(f"Updating {range_start} to {range_end} sale data from lightspeed")
+            # Midnights in the account's timezone, so the query covers the same days the store buckets by.
+            sales = self.get_sales(datetime.combine(range_start, time.min, tzinfo=self.timezone),
+                                   datetime.combine(range_end + timedelta(days=1), time.min, tzinfo=self.timezone))
+            count = store.replace_days(range_start, range_end, sales, today)
+            logging.info(f"Stored {count} sale lines")
+        store.prune(first_day)
+        return store
+
+    @property
+    def inventory_store(self) -> InventoryStore:
+        if not self.__inventory_store:
+            self.__inventory_store = InventoryStore(self.cache_file)
+        return self.__inventory_store
+
+    def get_inventory(self) -> Iterator[Item]:
+        self.sync_inventory()
+        # Only the fields the feeds use are kept, each item's json is dropped as soon as it is decoded.
+        return map(Item.from_json, self.inventory_store.in_stock_items())
+
+    def sync_inventory(self, full_sync: bool = False) -> None:
+        """
+        Bring the local inventory snapshot up to date. Only items and shop quantities changed since the last sync
+        are downloaded, except for a full download every full_sync_days.
+        :param full_sync: download the whole in-stock catalog regardless
+        """
+        store = self.inventory_store
+        item_timestamp = store.get_state(InventoryStore.ITEM_TIMESTAMP)
+        item_shop_timestamp = store.get_state(InventoryStore.ITEM_SHOP_TIMESTAMP)
+        if full_sync or store.needs_full_sync(self.full_sync_days) or not item_timestamp or not item_shop_timestamp:
+            logging.info("Downloading full lightspeed inventory")
+            count = store.replace_items(self.get_records('Item', {'load_relations': '["ItemShops"]',
+                                                                  'ItemShops.qoh': '>,0'}))
+            logging.info(f"Stored {count} items, rate limit {self.rate_limiter}")
+            return
+
+        logging.info(f"Updating lightspeed inventory changed since items={item_timestamp} shops={item_shop_timestamp}")
+        # Quantity changes only touch the ItemShop, so changed items and changed shops are fetched separately.
+        item_count = store.upsert_items(self.get_records('Item', {'load_relations': '["ItemShops"]',
+                                                                  'timeStamp': f'>,{item_timestamp}'}))
+        shop_count = store.upsert_item_shops(self.get_records('ItemShop', {'timeStamp': f'>,{item_shop_timestamp}'}))
+        missing_item_ids = store.missing_item_ids()
+        for start in range(0, len(missing_item_ids), self.page_size):
+            item_ids = ','.join([str(item_id) for item_id in missing_item_ids[start:start + self.page_size]])
+            item_count += store.upsert_items(self.get_records('Item', {'load_relations': '["ItemShops"]',
+                                                                       'itemID': f'IN,[{item_ids}]'}))
+        logging.info(f"Updated {item_count} items and {shop_count} item shops, rate limit {self.rate_limiter}")
+
+    def get_records(self, source: str, parameters: Dict[str, str] = None) -> Iterator[Dict]:
+        for page in self.get_pages(source, parameters):
+            yield from page
+
+    def get_pages(self, source: str, parameters: Dict[str, str] = None) -> Iterator[List[Dict]]:
+        """
+        Yield each page of records as soon as it arrives, while later pages are still downloading.
+        Offset paged responses (with a total count) fetch up to max_workers pages at once,
+        cursor paged responses (with a next link) fetch one page ahead.
+        :param source: Lightspeed resource, e.g. Item
+        :param parameters: query parameters
+        :return: pages of records
+        """
+        parameters = dict(parameters or {})
+        parameters['limit'] = str(self.page_size)
+        # Covers the whole download of the resource, including time the caller spends on each page.
+        with span('lightspeed.fetch', source) as data:
+            data['pages'] = data['records'] = 0
+            first_page = self.__get_page(self.__source_url(source, parameters), source)
+            attributes: Dict[str, str] = first_page.get('@attributes', {})
+            if 'next' not in attributes and 'count' in attributes:
+                pages = self.__get_offset_pages(source, parameters, first_page)
+            else:
+                pages = self.__get_cursor_pages(source, first_page)
+            for page in pages:
+                data['pages'] += 1
+                data['records'] += len(page)
+                yield page
+
+    def __get_cursor_pages(self, source: str, first_page: Dict) -> Iterator[List[Dict]]:
+        page = first_page
+        while page:
+            next_url = page.get('@attributes', {}).get('next')
+            next_page: Future = submit_in_context(self.executor, self.__get_page, next_url, source) \
+                if next_url else None
+            yield page_records(page, source)
+            page = next_page.result() if next_page else None
+
+    def __get_offset_pages(self, source: str, parameters: Dict[str, str], first_page: Dict) -> Iterator[List[Dict]]:
+        count = int(first_page['@attributes']['count'])
+        logging.info(f"Fetching {count} {source} records")
+        yield page_records(first_page, source)
+
+        offsets = iter(range(self.page_size, count, self.page_size))
+        pending: Deque[Future] = deque()
+        while True:
+            # Keep max_workers pages downloading, hand them back in order.
+            while len(pending) < self.max_workers:
+                offset = next(offsets, None)
+                if offset is None:
+                    break
+                pending.append(submit_in_context(self.executor, self.__get_page,
+                                                 self.__source_url(source, {**parameters, 'offset': str(offset)}),
+                                                 source))
+            if not pending:
+                return
+            yield page_records(pending.popleft().result(), source)
+
+    def __source_url(self, source: str, parameters: Dict[str, str]) -> str:
+        return f"{self.lightspeed.api_url}{source}.json?{parse.urlencode(parameters, safe=':-')}"
+
+    def __get_page(self, url: str, source: str) -> Dict:
+        response = self._get(url, cache_resource=source, headers=self.__auth_headers)
+        self._handle_response(response)
+        return response.json()
+
+    @property
+    def __auth_headers(self) -> Dict[str, str]:
+        # Check the bearer token is up to date.
+        with self.__token_lock:
+            bearer_token = self.lightspeed.get_token()
+        return {'Authorization': f'Bearer {bearer_token}', 'Accept': 'application/json'}
+
+    def _request(self, method: str, url: str, **kwargs):
+        # Lightspeed charges 1 unit of its leaky bucket for a read and 10 for a write.
+        cost = 1 if method == 'GET' else 10
+        self.rate_limiter.acquire(cost)
+        response = None
+        try:
+            response = super()._request(method, url, **kwargs)
+            return response
+        finally:
+            self.rate_limiter.release(cost, response.headers if response is not None else None)
+
+    @property
+    def workorder_store(self) -> WorkorderStore:
+        if not self.__workorder_store:
+            self.__workorder_store = WorkorderStore(self.cache_file)
+        return self.__workorder_store
+
+    def sync_workorders(self) -> int:
+        """
+        Download the workorders created or changed since the last sync into the workorder store,
+        every workorder on the first sync.
+        :return: number of workorders stored
+        """
+        store = self.workorder_store
+        timestamp = store.get_timestamp()
+        if timestamp:
+            logging.info(f"Updating lightspeed workorders changed since {timestamp}")
+            workorders = self.get_records('Workorder', {'timeStamp': f'>,{timestamp}'})
+        else:
+            logging.info("Downloading all lightspeed workorders")
+            workorders = self.get_records('Workorder')
+        count = store.upsert_workorders(workorders)
+        logging.info(f"Stored {count} workorders, {len(store)} in history, rate limit {self.rate_limiter}")
+        return count
+
+    def get_workorder_items(self, num_days: int = 21) -> List[Workorder]:
+        """
+        Open workorders checked in over the last num_days, from the workorder store
+        """
+        time_in_after = (datetime.now() - timedelta(days=num_days)).isoformat("T", "seconds")
         # Remove uninteresting ones
-        workorders = list(self.__filter_workorders(workorders, lambda x: self.__get_status(x) not in ['Done & Paid',
-                                                                                                      'Finished']))
+        finished_status_ids = [status_id for status_id, name in self.workorder_statuses.items()
+                               if name in ['Done & Paid', 'Finished']]
+        return list(self.workorder_store.workorders(time_in_after, excluded_status_ids=finished_status_ids))
 
+    def get_workload(self) -> Workload:
         # Get useful information from them
         # assignee_count = Counter(assigned_employee(workorders))
         # print_assigned_employee_count(assignee_count, self.employees, self.workorder_statuses)
         # plot_workorder_status(assignee_count, self.employees, self.workorder_statuses)
-        plot_workorder_allocation(workorders, self.employees)
-
-    def __filter_workorders(self, workorders: List[Dict], filter: Callable) -> List[Dict]:
-        for workorder in workorders:
-            if filter(workorder):
-                yield workorder
+        return Workload.from_workorders(self.get_workorder_items(), self.employees)
 
-    def __get_status(self, workorder) -> str:
-        return self.workorder_statuses[int(workorder['workorderStatusID'])]
+    @property
+    def timezone(self) -> tzinfo:
+        """
+        The account's timezone, which sales are bucketed into days by
+        """
+        if self.__timezone is None:
+            name = self.__timezone_name
+            if not name:
+                shops = list(self.get_records('Shop'))
+                name = shops[0].get('timeZone') if shops else None
+            try:
+                self.__timezone = ZoneInfo(name) if name else None
+            except (ValueError, ZoneInfoNotFoundError):
+                logging.warning(f"Unknown Lightspeed timezone {name}")
+            if self.__timezone is None:
+                logging.warning("Using the local timezone for Lightspeed sale days")
+                self.__timezone = datetime.now().astimezone().tzinfo
+        return self.__timezone
 
     @property
     def workorder_statuses(self) -> Dict[int, str]:
-        if not self.__workorder_statuses:
-            statuses = self.lightspeed.get('WorkorderStatus')['WorkorderStatus']
-            # status_objects = [WorkorderStatus(**status) for status in statuses]
-            self.__workorder_statuses = dict(
-                [(int(status['workorderStatusID']), status['name']) for status in statuses])
-        return self.__workorder_statuses
+        return self.__get_reference_data('WorkorderStatus', lambda records: dict(
+            [(status.workorderStatusID, status.name) for status in WorkorderStatus.from_json_list(records)]))
 
     @property
     def employees(self) -> Dict[int, str]:
-        if not self.__employees:
-            employees = self.lightspeed.get('Employee')['Employee']
-            self.__employees = dict([(int(employee['employeeID']), f'{employee["firstName"]} {employee["lastName"]}')
-                                     for employee in employees])
-        return self.__employees
+        return self.__get_reference_data('Employee', lambda records: dict(
+            [(int(employee['employeeID']), f'{employee["firstName"]} {employee["lastName"]}')
+             for employee in records]))
+
+    def __get_reference_data(self, resource: str,
+                             to_names: Callable[[Iterator[Dict]], Dict[int, str]]) -> Dict[int, str]:
+        """
+        Kept in memory only as long as the resource's cache TTL, so a connection kept for the whole process
+        still sees new employees and statuses
+        """
+        loaded = self.__reference_data.get(resource)
+        ttl = timedelta(seconds=self.cache_ttls.get(resource) or 0)
+        if loaded is None or datetime.now() - loaded[0] >= ttl:
+            loaded = (datetime.now(), to_names(self.get_records(resource)))
+            self.__reference_data[resource] = loaded
+        return loaded[1]
 
     @property
     def __lightspeed_config(self):
@@ -1,45 +1,211 @@
-import dateutil.parser
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 
-class WorkorderStatus(object):
-    def __init__(self, **kwargs):
-        self.workorderStatusID = int(kwargs.get('workorderStatusID', 0))
-        self.name = kwargs.get('name', '')
-        self.sortOrder = int(kwargs.get('sortOrder', 0))
-        self.htmlColor = kwargs.get('htmlColor', '')
-        self.systemValue = kwargs.get('systemValue', '')
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    """
+    Lightspeed's ISO-8601 timestamps, e.g. 2023-01-05T10:00:00-05:00, parsed by datetime's C decoder
+    with dateutil only as a fallback for anything it doesn't take
+    """
+    if not value:
+        return None
+    if value[-1] == 'Z':
+        value = value[:-1] + '+00:00'
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        import dateutil.parser
+
+        return dateutil.parser.parse(value)
+
+
+def to_int(value) -> int:
+    return int(value) if value not in (None, '') else 0
+
+
+def to_float(value) -> float:
+    return float(value) if value not in (None, '') else 0.0
+
+
+def to_optional_float(value) -> Optional[float]:
+    return float(value) if value not in (None, '') else None
+
+
+def to_bool(value) -> bool:
+    # Lightspeed sends booleans as 'true' and 'false'
+    return value is True or value == 'true'
+
 
+def to_str(value) -> str:
+    return value if value is not None else ''
+
+
+def to_list(value) -> List:
+    """
+    Lightspeed returns a lone record as an object instead of a list
+    """
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class LightspeedObject(object):
+    """
+    Compact model of a Lightspeed record, holding only its FIELDS in slots.
+    FIELDS pairs each attribute with the decoder of its json value, and optionally the json field it comes from
+    when that has another name.
+    """
+    __slots__ = ()
+    FIELDS: Tuple[Tuple, ...] = ()
+    __decoders: Tuple[Tuple[str, Callable, str], ...] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.__decoders = tuple([(field[0], field[1], field[2] if len(field) > 2 else field[0]) for field in cls.FIELDS])
 
-class Workorder(object):
     def __init__(self, **kwargs):
-        self.workorderID = int(kwargs.get('workorderID', 0))
-        self.timeIn = dateutil.parser.parse(kwargs.get('timeIn', '0000-01-01T00:00'))
-        self.etaOut = dateutil.parser.parse(kwargs.get('etaOut', '0000-01-01T00:00'))
-        self.note = kwargs.get('note', '')
-        self.warranty = bool(kwargs.get('warranty', False))
-        self.tax = bool(kwargs.get('tax', False))
-        self.archived = bool(kwargs.get('archived', False))
-        self.hookIn = kwargs.get('hookIn', '')
-        self.hookOut = kwargs.get('hookOut', '')
-        self.saveParts = bool(kwargs.get('saveParts', False))
-        self.assignEmployeeToAll = bool(kwargs.get('assignEmployeeToAll', False))
-        self.customerID = int(kwargs.get('customerID', 0))
-        self.discountID = int(kwargs.get('discountID', 0))
-        self.employeeID = int(kwargs.get('employeeID', 0))
-        self.serializedID = int(kwargs.get('serializedID', 0))
-        self.shopID = int(kwargs.get('shopID', 0))
-        self.saleID = int(kwargs.get('saleID', 0))
-        self.saleLineID = int(kwargs.get('saleLineID', 0))
-        self.workorderStatusID = int(kwargs.get('workorderStatusID', 0))
-        self.timeStamp = dateutil.parser.parse(kwargs.get('timeStamp', '0000-01-01T00:00'))
-
-        # TODO - sub objects
-        self.Customer = kwargs.get('Customer', 0)  # TODO
-        self.Discount = kwargs.get('Discount', 0)  # TODO
-        self.Employee = kwargs.get('Employee', 0)  # TODO
-        self.Serialized = kwargs.get('Serialized', 0)  # TODO
-        self.WorkorderStatus = kwargs.get('WorkorderStatus', 0)  # TODO
-        self.WorkorderItems = kwargs.get('WorkorderItems', 0)  # TODO
-        self.WorkorderLines = kwargs.get('WorkorderLines', 0)  # TODO
-        self.CustomFieldValues = kwargs.get('CustomFieldValues', 0)  # TODO
+        for name, decode, source in self.__decoders:
+            setattr(self, name, decode(kwargs.get(source)))
+
+    @classmethod
+    def from_json(cls, record: Dict) -> 'LightspeedObject':
+        obj = cls.__new__(cls)
+        get = record.get
+        for name, decode, source in cls.__decoders:
+            setattr(obj, name, decode(get(source)))
+        return obj
+
+    @classmethod
+    def from_json_list(cls, records: Iterable[Dict]) -> List['LightspeedObject']:
+        from_json = cls.from_json
+        return [from_json(record) for record in records]
+
+    def __repr__(self):
+        fields = ', '.join([f'{field[0]}={getattr(self, field[0])!r}' for field in self.FIELDS[:3]])
+        return f'{type(self).__name__}({fields})'
+
+
+def field_names(fields: Tuple[Tuple, ...]) -> Tuple[str, ...]:
+    return tuple([field[0] for field in fields])
+
+
+class WorkorderStatus(LightspeedObject):
+    FIELDS = (('workorderStatusID', to_int),
+              ('name', to_str),
+              ('sortOrder', to_int),
+              ('htmlColor', to_str),
+              ('systemValue', to_str))
+    __slots__ = field_names(FIELDS)
+
+
+class Workorder(LightspeedObject):
+    # TODO - sub objects, Customer, Discount, Employee, Serialized, WorkorderItems, WorkorderLines, ...
+    FIELDS = (('workorderID', to_int),
+              ('timeIn', parse_timestamp),
+              ('etaOut', parse_timestamp),
+              ('note', to_str),
+              ('warranty', to_bool),
+              ('tax', to_bool),
+              ('archived', to_bool),
+              ('hookIn', to_str),
+              ('hookOut', to_str),
+              ('saveParts', to_bool),
+              ('assignEmployeeToAll', to_bool),
+              ('customerID', to_int),
+              ('discountID', to_int),
+              ('employeeID', to_int),
+              ('serializedID', to_int),
+              ('shopID', to_int),
+              ('saleID', to_int),
+              ('saleLineID', to_int),
+              ('workorderStatusID', to_int),
+              ('timeStamp', parse_timestamp))
+    __slots__ = field_names(FIELDS)
+
+
+class ItemShop(LightspeedObject):
+    FIELDS = (('itemShopID', to_int),
+              ('itemID', to_int),
+              ('shopID', to_int),
+              ('qoh', to_int),
+              ('timeStamp', parse_timestamp))
+    __slots__ = field_names(FIELDS)
+
+
+def item_shop_list(value) -> Tuple[ItemShop, ...]:
+    """
+    :param value: the ItemShops relation of an item
+    """
+    return tuple(ItemShop.from_json_list(to_list((value or {}).get('ItemShop'))))
+
+
+def first_price(value) -> float:
+    """
+    :param value: the Prices relation of an item
+    :return: amount of the first ItemPrice, the default price
+    """
+    prices = to_list((value or {}).get('ItemPrice'))
+    return to_float(prices[0].get('amount')) if prices else 0.0
+
+
+class Item(LightspeedObject):
+    """
+    The fields of an item the feeds use, with its ItemShops and default price
+    """
+    FIELDS = (('itemID', to_int),
+              ('systemSku', to_str),
+              ('upc', to_str),
+              ('ean', to_str),
+              ('customSku', to_str),
+              ('manufacturerSku', to_str),
+              ('description', to_str),
+              ('defaultCost', to_float),
+              ('avgCost', to_float),
+              ('price', first_price, 'Prices'),
+              ('ItemShops', item_shop_list),
+              ('timeStamp', parse_timestamp))
+    __slots__ = field_names(FIELDS)
+
+
+def to_record(value) -> Optional[Dict]:
+    return value or None
+
+
+class SaleLine(LightspeedObject):
+    """
+    The Item is kept as its json record, which the sales store saves for the recent sale feed
+    """
+    FIELDS = (('saleLineID', to_int),
+              ('saleID', to_int),
+              ('itemID', to_int),
+              ('unitQuantity', to_int),
+              ('unitPrice', to_float),
+              ('calcSubtotal', to_optional_float),
+              ('Item', to_record))
+    __slots__ = field_names(FIELDS)
+
+    @property
+    def revenue(self) -> float:
+        if self.calcSubtotal is not None:
+            return self.calcSubtotal
+        return self.unitPrice * self.unitQuantity
+
+
+def sale_line_list(value) -> Tuple[SaleLine, ...]:
+    """
+    :param value: the SaleLines relation of a sale
+    """
+    return tuple(SaleLine.from_json_list(to_list((value or {}).get('SaleLine'))))
+
 
+class Sale(LightspeedObject):
+    FIELDS = (('saleID', to_int),
+              ('completed', to_bool),
+              ('completeTime', parse_timestamp),
+              ('employeeID', to_int),
+              ('shopID', to_int),
+              ('calcSubtotal', to_float),
+              ('calcTotal', to_float),
+              ('SaleLines', sale_line_list),
+              ('timeStamp', parse_timestamp))
+    __slots__ = field_names(FIELDS)
@@ -1,38 +1,68 @@
 import argparse
 import datetime
+import functools
+import json
 import logging
 import os
 import sys
-from typing import Dict, Union, Callable, List
-
-import requests
-import sentry_sdk
-from sentry_sdk.integrations.logging import LoggingIntegration
+import threading
+from typing import Dict, Union, Callable, List, TYPE_CHECKING, Any, Optional
 
 from config import ReserConfig
-from datafeed import qoh, create_and_upload_inventory, create_and_upload_recent_sale, get_report_item
-from shippolink import ShippoConnection
-from smartetailing.connection import SmartetailingConnection
-import lightspeedconnection
+from importtimer import ImportTimer
+from runreport import transaction
+
+# Each command imports its own dependencies when it runs, so e.g. syncshippo never pays for pandas or matplotlib.
+if TYPE_CHECKING:
+    from lightspeedconnection import LightspeedConnection
+    from responsecache import ResponseCache
+    from shippolink import ShippoConnection
 
 
 def create_function_map() -> Dict[str, Callable]:
     return {'syncshippo': sync_shippo,
+            'rebuildshippoindex': rebuild_shippo_index,
             'downloadschedule': download_lightspeed_schedule,
             'displayschedule': display_schedule_info,
             'inventoryspreadsheet': inventory_spreadsheet,
             'getaccesstoken': get_access_token,
-            'downloadreviews': download_reviews
+            'downloadreviews': download_reviews,
+            'serve': serve
             }
 
 
+def cached_connection(factory: Callable[[Dict], Any]) -> Callable[[Dict], Any]:
+    """
+    Reuse the connection created for the same configuration, so a long-running process keeps its
+    HTTP sessions, tokens and cached lookups warm between runs.
+    """
+    connections: Dict[str, Any] = dict()
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get_connection(connection_config: Dict) -> Any:
+        key = json.dumps(connection_config, sort_keys=True, default=str)
+        with lock:
+            if key not in connections:
+                connections[key] = factory(connection_config)
+            return connections[key]
+
+    return get_connection
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('command', help="Perform an action", choices=create_function_map().keys())
+    parser.add_argument('--import-time', action='store_true',
+                        help="Log how long the command spent importing modules")
+    parser.add_argument('--profile', action='store_true',
+                        help="Save cProfile stats of the command to profile_<command>.prof")
     return parser.parse_args()
 
 
 def download_reviews() -> None:
+    import requests
+
     config = ReserConfig.get_config()
     review_url = "https://display.powerreviews.com/m/2568/l/en_US/product/0_0_387915/reviews?apikey=51e5c335-f79d-43e9-9c41-f3095d711fdb&_noconfig=true"
     response = requests.get(review_url)
@@ -40,12 +70,14 @@ def download_reviews() -> None:
 
 
 def sync_shippo() -> None:
+    from smartetailing.connection import SmartetailingConnection
+    from xmlstream import SmartetailingOrderStream
+
     config = ReserConfig.get_config()
     etailing_config: Dict[str, Union[str, int]] = config["smartetailing"]
     shippo_config: Dict[str, Union[str, int, List[str]]] = config["shippo"]
 
-    shippo_connection = ShippoConnection(shippo_config["apikey"],
-                                         include_order_status=shippo_config['include_order_status'])
+    shippo_connection = create_shippo_connection(shippo_config)
     smartetailing_connection = SmartetailingConnection(etailing_config["base_url"],
                                                        etailing_config["merchant_id"],
                                                        etailing_config["url_key"],
@@ -53,89 +85,243 @@ def sync_shippo() -> None:
                                                        etailing_config["username"],
                                                        etailing_config["password"])
 
-    shippo_connection.send_to_shippo(config["return_address"], smartetailing_connection.export_orders())
+    # Pull new Shippo order ids while Smartetailing builds the export.
+    shippo_connection.prefetch_order_index()
+    # Orders reach the Shippo filters as they are parsed, without waiting for the whole export.
+    orders = SmartetailingOrderStream(smartetailing_connection).export_orders()
+    result = shippo_connection.send_to_shippo(config["return_address"], orders)
+    if result.failed:
+        raise RuntimeError(f"Failed to create Shippo orders {', '.join(sorted(result.failed))}")
+
+
+def rebuild_shippo_index() -> None:
+    logging.info("Rebuilding Shippo order index")
+    shippo_config: Dict[str, Union[str, int, List[str]]] = ReserConfig.get_config()["shippo"]
+
+    create_shippo_connection(shippo_config).sync_order_index(rebuild=True)
+
+
+@cached_connection
+def create_shippo_connection(shippo_config: Dict[str, Union[str, int, List[str]]]) -> 'ShippoConnection':
+    from shippolink import ShippoConnection
+
+    dir_path: str = os.path.dirname(os.path.realpath(__file__))
+    index_file = os.path.join(dir_path, shippo_config.get("index_file", "shippo_orders.json"))
+    return ShippoConnection(shippo_config["apikey"],
+                            include_order_status=shippo_config['include_order_status'],
+                            index_file=index_file,
+                            timeout=shippo_config.get("timeout"),
+                            max_workers=shippo_config.get("max_workers"),
+                            max_retries=shippo_config.get("max_retries"),
+                            base_url=shippo_config.get("base_url"),
+                            response_cache=create_response_cache(),
+                            cache_ttls=shippo_config.get("cache_ttls"))
+
+
+@cached_connection
+def create_lightspeed_connection(lightspeed_config: Dict) -> 'LightspeedConnection':
+    from lightspeedconnection import LightspeedConnection
+
+    return LightspeedConnection(lightspeed_config["cache_file"],
+                                lightspeed_config['account_id'],
+                                lightspeed_config["client_id"],
+                                lightspeed_config["client_secret"],
+                                lightspeed_config["token_info"]["refresh_token"],
+                                max_workers=lightspeed_config.get("max_workers"),
+                                page_size=lightspeed_config.get("page_size"),
+                                full_sync_days=lightspeed_config.get("full_sync_days"),
+                                response_cache=create_response_cache(),
+                                cache_ttls=lightspeed_config.get("cache_ttls"),
+                                timezone=lightspeed_config.get("timezone"))
+
+
+@functools.lru_cache(maxsize=None)
+def create_response_cache() -> Optional['ResponseCache']:
+    """
+    The on-disk GET response cache every connection shares, None if config["response_cache"]["enabled"] is false
+    """
+    from responsecache import ResponseCache
+
+    cache_config: Dict = ReserConfig.get_config().get("response_cache", {})
+    if not cache_config.get("enabled", True):
+        return None
+    max_size_mb = cache_config.get("max_size_mb")
+    return ResponseCache(cache_config.get("cache_file", "response_cache.db"),
+                         int(float(max_size_mb) * 1024 * 1024) if max_size_mb else None)
 
 
 def download_lightspeed_schedule() -> None:
     logging.info("Downloading lightspeed work order schedule")
     config: Dict = ReserConfig.get_config()["lightspeed"]
 
-    # Load the existing data file
-    connection = lightspeedconnection.LightspeedConnection(config["cache_file"],
-                                                           config['account_id'],
-                                                           config["client_id"],
-                                                           config["client_secret"],
-                                                           config["token_info"]["refresh_token"])
-    # Connect to lightspeed
-    connection.get_workorder_items()
-    # TODO - Pull workorder data
-    # TODO - Append to data table
-    # TODO - Store back to data file
-    pass
+    connection = create_lightspeed_connection(config)
+    # Bring the workorder history in cache_file up to date
+    connection.sync_workorders()
+    workload = connection.get_workload()
+    dir_path: str = os.path.dirname(os.path.realpath(__file__))
+    workload.save(os.path.join(dir_path, config.get("workload_file", "workload.png")))
 
 
 def display_schedule_info() -> None:
-    raise NotImplementedError
+    """
+    Serve the schedule from the workorder history until stopped, downloadschedule keeps the history up to date.
+    """
+    from scheduleview import ScheduleView, serve_schedule_view
+
+    config: Dict = ReserConfig.get_config()["lightspeed"]
+    view_config: Dict = ReserConfig.get_config().get("schedule_view", {})
+
+    connection = create_lightspeed_connection(config)
+    view = ScheduleView(connection.workorder_store, lambda: connection.employees,
+                        lambda: connection.workorder_statuses,
+                        num_days=int(view_config.get("num_days", 21)),
+                        refresh_interval=float(view_config.get("refresh_interval", 5)))
+    serve_schedule_view(view, view_config.get("host", "127.0.0.1"), int(view_config.get("port", 5000)))
 
 
 def get_access_token() -> None:
     logging.info("Getting access token from lightspeed")
     lightspeed_config: Dict = ReserConfig.get_config()["lightspeed"]
 
-    connection = lightspeedconnection.LightspeedConnection(lightspeed_config["cache_file"],
-                                                           lightspeed_config['account_id'],
-                                                           lightspeed_config["client_id"],
-                                                           lightspeed_config["client_secret"],
-                                                           lightspeed_config["token_info"]["refresh_token"])
+    connection = create_lightspeed_connection(lightspeed_config)
     connection.get_access_token()
 
 
 def inventory_spreadsheet() -> None:
+    from datafeed import qoh, create_and_upload_inventory, create_and_upload_recent_sale, create_feed_snapshot, \
+        wait_for_uploads
+    from stagerunner import StageRunner
+
     logging.info("Updating inventory spreadsheet from lightspeed")
     lightspeed_config: Dict = ReserConfig.get_config()["lightspeed"]
     aws_config: Dict = ReserConfig.get_config()["aws"]
 
-    connection = lightspeedconnection.LightspeedConnection(lightspeed_config["cache_file"],
-                                                           lightspeed_config['account_id'],
-                                                           lightspeed_config["client_id"],
-                                                           lightspeed_config["client_secret"],
-                                                           lightspeed_config["token_info"]["refresh_token"])
-    inventory_items = connection.get_inventory()
+    connection = create_lightspeed_connection(lightspeed_config)
     sale_days = int(lightspeed_config['sale_history_days'])
-    recent_sale_items = connection.get_recent_sales(sale_days)
+    snapshot = create_feed_snapshot(lightspeed_config['cache_file']) if aws_config.get('delta_feeds') else None
+
+    def fetch_recent_sales():
+        return list(connection.get_recent_sales(sale_days))
+
+    def in_stock_skus(inventory_items):
+        return dict([(item.systemSku, item) for item in inventory_items if qoh(item) > 0])
+
+    def report_skus(inventory_system_skus, recent_sale_items):
+        report_system_skus = dict()
+        report_system_skus.update(inventory_system_skus)
+        report_system_skus.update([(item.systemSku, item) for item in recent_sale_items])
+        return report_system_skus
+
+    def upload_recent_sale_feed(report_system_skus, velocity):
+        wait_for_uploads(create_and_upload_recent_sale(aws_config, report_system_skus.values(), velocity, snapshot))
+
+    def upload_inventory_feed(inventory_system_skus, velocity):
+        wait_for_uploads(create_and_upload_inventory(aws_config, inventory_system_skus.values(), velocity, snapshot))
+
+    # The inventory and sales downloads run side by side, then the two feeds build and upload side by side.
+    runner = StageRunner()
+    runner.add('inventory', lambda: list(connection.get_inventory()))
+    runner.add('recent_sales', fetch_recent_sales)
+    runner.add('velocity', lambda _: connection.sales_store.velocity(), requires=['recent_sales'])
+    runner.add('inventory_skus', in_stock_skus, requires=['inventory'])
+    runner.add('report_skus', report_skus, requires=['inventory_skus', 'recent_sales'])
+    runner.add('recent_sale_feed', upload_recent_sale_feed, requires=['report_skus', 'velocity'])
+    runner.add('inventory_feed', upload_inventory_feed, requires=['inventory_skus', 'velocity'])
+    runner.run()
+    if snapshot:
+        # The next delta is against what was actually published.
+        snapshot.commit()
+
+
+def serve() -> None:
+    """
+    Run the commands in config["schedule"] ({command: interval seconds}) inside this process until stopped.
+    """
+    from scheduler import JobScheduler
+
+    schedule_config: Dict[str, int] = ReserConfig.get_config()["schedule"]
+    function_map = create_function_map()
+    scheduler = JobScheduler()
+    for command, interval in schedule_config.items():
+        if command == 'serve' or command not in function_map:
+            raise ValueError(f"Cannot schedule {command}")
+        scheduler.add_job(command, instrumented(command, function_map[command]), float(interval))
+    scheduler.run_forever()
+
+
+def instrumented(command: str, func: Callable[[], None]) -> Callable[[], None]:
+    """
+    Run func as a Sentry transaction and save its stage timings to the run report file,
+    config["logging"]["run_report_file"] with {command} filled in.
+    """
+    logging_config: Dict = ReserConfig.get_config()["logging"]
+    dir_path: str = os.path.dirname(os.path.realpath(__file__))
+    report_file = os.path.join(dir_path, logging_config.get("run_report_file", "run_report_{command}.json")
+                               .format(command=command))
+
+    @functools.wraps(func)
+    def run() -> None:
+        with transaction(command, report_file):
+            func()
 
-    logging.info("Sorting inventory data")
-    inventory_system_skus = dict([(item['systemSku'], get_report_item(item)) for item in inventory_items if qoh(item) > 0])
-    recent_sale_system_skus = dict([(item['systemSku'], get_report_item(item)) for item in recent_sale_items])
-    report_system_skus = dict()
-    report_system_skus.update(inventory_system_skus)
-    report_system_skus.update(recent_sale_system_skus)
+    return run
 
-    create_and_upload_recent_sale(aws_config, report_system_skus.values())
-    create_and_upload_inventory(aws_config, inventory_system_skus.values())
+
+def run_profiled(command: str, func: Callable[[], None]) -> None:
+    """
+    Run func under cProfile, saving the stats and logging the slowest calls.
+    Only the calling thread is profiled, work on the connection thread pools shows up as waits.
+    """
+    import cProfile
+    import io
+    import pstats
+
+    dir_path: str = os.path.dirname(os.path.realpath(__file__))
+    profile_file = os.path.join(dir_path, f"profile_{command}.prof")
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_file)
+        stats_output = io.StringIO()
+        pstats.Stats(profiler, stream=stats_output).sort_stats('cumulative').print_stats(20)
+        logging.info(f"Saved profile to {profile_file}\n{stats_output.getvalue()}")
 
 
 def main():
     """
     Main entry point for the application
     """
+    args = parse_arguments()
+    import_timer = ImportTimer().start() if args.import_time else None
     initialize_logging()
     time_now = datetime.datetime.now()
     exit_code = 0
     try:
-        args = parse_arguments()
         func = create_function_map()[args.command]
-        func()
+        # serve instruments each job it runs instead.
+        if args.command != 'serve':
+            func = instrumented(args.command, func)
+        if args.profile:
+            run_profiled(args.command, func)
+        else:
+            func()
     except Exception as err:
         logging.exception('Fatal error in main')
         exit_code = -1
     finally:
         time_end = datetime.datetime.now()
         logging.debug(f'Finished {(time_end - time_now).seconds} sec')
+        if import_timer:
+            import_timer.stop()
+            import_timer.log_report(args.command)
         sys.exit(exit_code)
 
 
 def initialize_logging():
+    import sentry_sdk
+    from sentry_sdk.integrations.logging import LoggingIntegration
+
     dir_path: str = os.path.dirname(os.path.realpath(__file__))
     config = ReserConfig.get_config()
 
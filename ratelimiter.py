@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+from typing import Dict, Mapping
+
+
+class LeakyBucketLimiter:
+    """
+    Client side model of a leaky bucket rate limit, like Lightspeed's.
+    Each request adds its cost to the bucket, which drains at drip_rate units per second, and requests wait
+    while the bucket is too full. The model is corrected from the bucket level the server reports.
+    """
+    LEVEL_HEADER = 'X-LS-API-Bucket-Level'
+    DRIP_RATE_HEADER = 'X-LS-API-Drip-Rate'
+    __limiters: Dict[str, 'LeakyBucketLimiter'] = dict()
+    __limiters_lock = threading.Lock()
+
+    def __init__(self, capacity: float = 60, drip_rate: float = 1, headroom: float = 2):
+        """
+        :param capacity: bucket size, until the server reports it
+        :param drip_rate: units drained per second, until the server reports it
+        :param headroom: units kept free, so requests from other clients don't tip us over
+        """
+        self.capacity = capacity
+        self.drip_rate = drip_rate
+        self.headroom = headroom
+        self.wait_count = 0
+        self.wait_seconds = 0.0
+        self.__level = 0.0
+        self.__in_flight = 0.0
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def shared(key: str) -> 'LeakyBucketLimiter':
+        """
+        One limiter per key, e.g. per account, shared by every connection in the process
+        """
+        with LeakyBucketLimiter.__limiters_lock:
+            if key not in LeakyBucketLimiter.__limiters:
+                LeakyBucketLimiter.__limiters[key] = LeakyBucketLimiter()
+            return LeakyBucketLimiter.__limiters[key]
+
+    @property
+    def level(self) -> float:
+        with self.__lock:
+            return self.__drain()
+
+    @property
+    def fill(self) -> float:
+        """
+        Current bucket level as a fraction of capacity
+        """
+        return self.level / self.capacity
+
+    def acquire(self, cost: float = 1) -> None:
+        """
+        Wait until the bucket has room for a request, then reserve it
+        :param cost: bucket units the request uses, Lightspeed charges 1 for a read and 10 for a write
+        """
+        while True:
+            with self.__lock:
+                level = self.__drain()
+                wait_time = (level + cost - (self.capacity - self.headroom)) / self.drip_rate
+                if wait_time <= 0:
+                    self.__level = level + cost
+                    self.__in_flight += cost
+                    return
+            self.wait_count += 1
+            self.wait_seconds += wait_time
+            logging.debug(f"Rate limit bucket at {level:.0f}/{self.capacity:.0f}, waiting {wait_time:.1f} sec")
+            time.sleep(wait_time)
+
+    def release(self, cost: float = 1, headers: Mapping[str, str] = None) -> None:
+        """
+        Finish a reserved request, correcting the bucket from the level the server reported
+        :param cost: cost passed to acquire
+        :param headers: response headers, None if the request failed without a response
+        """
+        with self.__lock:
+            self.__in_flight = max(0.0, self.__in_flight - cost)
+            bucket_level = headers.get(LeakyBucketLimiter.LEVEL_HEADER) if headers else None
+            if bucket_level:
+                try:
+                    level, capacity = [float(value) for value in bucket_level.split('/')]
+                    drip_rate = float(headers.get(LeakyBucketLimiter.DRIP_RATE_HEADER) or self.drip_rate)
+                except ValueError:
+                    logging.warning(f"Unexpected bucket level {bucket_level}")
+                    return
+                # The reported level already includes this request, but not the others still in flight.
+                self.capacity = capacity
+                self.drip_rate = drip_rate
+                self.__level = level + self.__in_flight
+                self.__updated = time.monotonic()
+
+    def __drain(self) -> float:
+        now = time.monotonic()
+        self.__level = max(0.0, self.__level - (now - self.__updated) * self.drip_rate)
+        self.__updated = now
+        return self.__level
+
+    def __str__(self):
+        return f"level={self.level:.1f}/{self.capacity:.0f} fill={self.fill:.0%} drip_rate={self.drip_rate:g}/sec " \
+               f"waits={self.wait_count} waited={self.wait_seconds:.1f} sec"
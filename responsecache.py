@@ -0,0 +1,129 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from typing import Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from sqlitestore import SQLiteStore
+
+# Response headers kept with a cached body, the rest aren't needed to use or revalidate it
+STORED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Date']
+
+
+class CachedResponse:
+    """
+    A stored GET response, with the time it was last fetched or revalidated
+    """
+
+    def __init__(self, url: str, body: bytes, headers: Dict[str, str], stored: float):
+        self.url = url
+        self.body = body
+        self.headers = headers
+        self.stored = stored
+
+    def age(self) -> float:
+        return time.time() - self.stored
+
+    def validators(self) -> Dict[str, str]:
+        """
+        Conditional request headers, empty if the server sent neither an ETag nor a Last-Modified
+        """
+        headers = dict()
+        if self.headers.get('ETag'):
+            headers['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def to_response(self) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(self.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.body
+        return response
+
+
+class ResponseCache(SQLiteStore):
+    """
+    On-disk SQLite cache of GET responses, shared by the connections and kept between runs.
+    Each entry belongs to a resource, whose TTL the connection decides. Once the size of the bodies
+    passes max_bytes, the least recently used entries are evicted.
+    """
+    DEFAULT_MAX_BYTES = 50 * 1024 * 1024
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS http_response (
+            key TEXT PRIMARY KEY,
+            resource TEXT NOT NULL,
+            url TEXT NOT NULL,
+            headers TEXT NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            stored REAL NOT NULL,
+            last_used REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS http_response_last_used ON http_response (last_used);
+    """
+
+    def __init__(self, db_file: str, max_bytes: int = None):
+        super().__init__(db_file)
+        self.max_bytes = max_bytes or ResponseCache.DEFAULT_MAX_BYTES
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.__stats_lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        with closing(self.connect()) as db, db:
+            row = db.execute("SELECT url, headers, body, stored FROM http_response WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            db.execute("UPDATE http_response SET last_used = ? WHERE key = ?", (time.time(), key))
+        url, headers, body, stored = row
+        return CachedResponse(url, body, json.loads(headers), stored)
+
+    def put(self, key: str, resource: str, response: requests.Response) -> None:
+        """
+        Store a successful response, then evict down to max_bytes
+        """
+        headers = dict([(name, response.headers[name]) for name in STORED_HEADERS if name in response.headers])
+        body = response.content
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.execute("""
+                INSERT OR REPLACE INTO http_response (key, resource, url, headers, body, size, stored, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                       (key, resource, response.url, json.dumps(headers), body, len(body), now, now))
+            self.__evict(db)
+
+    def touch(self, key: str) -> None:
+        """
+        Restart the TTL of an entry the server said is unchanged
+        """
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.execute("UPDATE http_response SET stored = ?, last_used = ? WHERE key = ?", (now, now, key))
+
+    def __evict(self, db: sqlite3.Connection) -> None:
+        # Keep the most recently used entries that fit in max_bytes.
+        evicted = db.execute("""
+            DELETE FROM http_response WHERE key IN (
+                SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total
+                                 FROM http_response)
+                WHERE total > ?)""", (self.max_bytes,)).rowcount
+        if evicted:
+            logging.debug(f"Evicted {evicted} responses from {self.db_file}")
+
+    def count(self, outcome: str) -> None:
+        with self.__stats_lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def __str__(self):
+        return f"hits={self.hits} revalidated={self.revalidated} misses={self.misses}"
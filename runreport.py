@@ -0,0 +1,153 @@
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class RunReport:
+    """
+    Timings of the stages of one command run, kept as a flat list of spans and saved as JSON.
+    Spans go to the report of the run they belong to, see current_report and submit_in_context.
+    """
+
+    def __init__(self, command: str):
+        self.command = command
+        self.started = datetime.now()
+        self.status = 'ok'
+        self.spans: List[Dict[str, Any]] = []
+        self.__start = time.perf_counter()
+        self.__end: Optional[float] = None
+        self.__lock = threading.Lock()
+
+    def stop(self, status: str = 'ok') -> None:
+        self.status = status
+        self.__end = time.perf_counter()
+
+    def add_span(self, op: str, description: Optional[str], start: float, end: float, status: str,
+                 data: Dict[str, Any]) -> None:
+        span = {'op': op,
+                'description': description,
+                'start_sec': round(start - self.__start, 6),
+                'duration_sec': round(end - start, 6),
+                'thread': threading.current_thread().name,
+                'status': status}
+        if data:
+            span['data'] = dict(data)
+        with self.__lock:
+            self.spans.append(span)
+
+    @property
+    def duration(self) -> float:
+        return (self.__end or time.perf_counter()) - self.__start
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Count, total and longest duration of the spans of each op
+        """
+        summary: Dict[str, Dict[str, float]] = dict()
+        with self.__lock:
+            spans = list(self.spans)
+        for span in spans:
+            op_summary = summary.setdefault(span['op'], {'count': 0, 'total_sec': 0.0, 'max_sec': 0.0})
+            op_summary['count'] += 1
+            op_summary['total_sec'] = round(op_summary['total_sec'] + span['duration_sec'], 6)
+            op_summary['max_sec'] = max(op_summary['max_sec'], span['duration_sec'])
+        return summary
+
+    def to_json(self) -> Dict[str, Any]:
+        with self.__lock:
+            spans = sorted(self.spans, key=lambda span: span['start_sec'])
+        return {'command': self.command,
+                'started': self.started.isoformat(),
+                'duration_sec': round(self.duration, 6),
+                'status': self.status,
+                'summary': self.summary(),
+                'spans': spans}
+
+    def save(self, report_file: str) -> None:
+        with open(report_file, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+        logging.info(f"Saved {self.command} run report with {len(self.spans)} spans to {report_file}")
+
+
+# Report of the command running in this context, scheduled jobs each run in their own thread and context
+current_report: contextvars.ContextVar[Optional[RunReport]] = contextvars.ContextVar('current_report', default=None)
+
+
+def submit_in_context(executor: Executor, func: Callable, *args, **kwargs) -> Future:
+    """
+    Submit func to a worker pool in a copy of the caller's context, so its spans go to the caller's report
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+@contextmanager
+def span(op: str, description: str = None, **data) -> Iterator[Dict[str, Any]]:
+    """
+    Time a stage, as a Sentry span when Sentry is set up and in the current RunReport.
+    :param op: kind of stage, e.g. s3.upload
+    :param description: which one, e.g. the uri
+    :param data: extra values to record, the yielded dict takes more while the stage runs
+    """
+    # Only commands that set up Sentry have imported it, nothing here imports it.
+    sentry_sdk = sys.modules.get('sentry_sdk')
+    parent = sentry_sdk.Hub.current.scope.span if sentry_sdk else None
+    # A child of the running transaction, started without making it the scope's current span,
+    # because worker threads share that scope.
+    sentry_span = parent.start_child(op=op, description=description) if parent else None
+    status = 'ok'
+    start = time.perf_counter()
+    try:
+        yield data
+    except GeneratorExit:
+        # A generator stopped early by its consumer, not a failure.
+        raise
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        end = time.perf_counter()
+        if sentry_span:
+            for key, value in data.items():
+                sentry_span.set_data(key, value)
+            sentry_span.set_status('ok' if status == 'ok' else 'internal_error')
+            sentry_span.finish()
+        report = current_report.get()
+        if report:
+            report.add_span(op, description, start, end, status, data)
+
+
+@contextmanager
+def transaction(command: str, report_file: str = None) -> Iterator[RunReport]:
+    """
+    Run a command as a Sentry transaction, and save its RunReport to report_file
+    """
+    sentry_sdk = sys.modules.get('sentry_sdk')
+    sentry_transaction = sentry_sdk.start_transaction(op='command', name=command) if sentry_sdk else None
+    report = RunReport(command)
+    token = current_report.set(report)
+    status = 'ok'
+    try:
+        if sentry_transaction:
+            sentry_transaction.__enter__()
+        yield report
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        report.stop(status)
+        current_report.reset(token)
+        if sentry_transaction:
+            sentry_transaction.set_status('ok' if status == 'ok' else 'internal_error')
+            sentry_transaction.__exit__(None, None, None)
+        if report_file:
+            try:
+                report.save(report_file)
+            except OSError:
+                logging.exception(f"Could not save run report {report_file}")
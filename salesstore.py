@@ -0,0 +1,168 @@
+import json
+from contextlib import closing
+from datetime import date, datetime, timedelta, tzinfo
+from typing import Dict, Iterable, Iterator, List, Set
+
+import numpy as np
+
+from lightspeedobjects import Sale
+from sqlitestore import SQLiteStore
+
+# Windows of the sales velocity columns, in days
+VELOCITY_DAYS = [7, 30, 90]
+
+
+class SalesVelocity:
+    """
+    Units sold and revenue of each SKU over each window of days, as extra report columns.
+    """
+
+    def __init__(self, system_skus: List[str], units: np.ndarray, revenue: np.ndarray, windows: List[int]):
+        """
+        :param units: SKU by window
+        :param revenue: SKU by window
+        """
+        self.windows = windows
+        self.units = units
+        self.revenue = revenue
+        self.__sku_index = dict([(system_sku, index) for index, system_sku in enumerate(system_skus)])
+        self.__zero_row = [0] * len(windows) + ['$%.2f' % 0] * len(windows)
+
+    @property
+    def columns(self) -> List[str]:
+        return [f'Units {days}d' for days in self.windows] + [f'Revenue {days}d' for days in self.windows]
+
+    def row(self, system_sku: str) -> List:
+        """
+        :return: display formatted values for columns
+        """
+        index = self.__sku_index.get(system_sku)
+        if index is None:
+            return self.__zero_row
+        return [int(units) for units in self.units[index]] + ['$%.2f' % revenue for revenue in self.revenue[index]]
+
+
+class SalesStore(SQLiteStore):
+    """
+    Local SQLite record of Lightspeed sale lines in daily buckets, keyed by the day the sale completed
+    in the account's timezone. A day is fetched again until it has passed, after that its bucket is reused
+    by every later run.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sale_day (day TEXT PRIMARY KEY, complete INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS sale_line (
+            sale_line_id INTEGER PRIMARY KEY,
+            day TEXT NOT NULL,
+            system_sku TEXT NOT NULL,
+            units INTEGER NOT NULL,
+            revenue REAL NOT NULL);
+        CREATE INDEX IF NOT EXISTS sale_line_day ON sale_line (day);
+        CREATE TABLE IF NOT EXISTS sale_item (system_sku TEXT PRIMARY KEY, item_json TEXT NOT NULL);
+    """
+
+    def __init__(self, db_file: str, timezone: tzinfo = None):
+        """
+        :param timezone: the account's timezone, which the days are in, the machine's local timezone if None
+        """
+        super().__init__(db_file)
+        self.timezone = timezone
+
+    def today(self) -> date:
+        return datetime.now(self.timezone).date()
+
+    def complete_days(self) -> Set[date]:
+        with closing(self.connect()) as db:
+            rows = db.execute("SELECT day FROM sale_day WHERE complete").fetchall()
+        return set([date.fromisoformat(row[0]) for row in rows])
+
+    def missing_days(self, first_day: date, today: date = None) -> List[date]:
+        """
+        Days from first_day to today that still need fetching, today is never complete
+        """
+        today = today or self.today()
+        complete_days = self.complete_days()
+        return [day for day in [first_day + timedelta(days=offset) for offset in range((today - first_day).days + 1)]
+                if day not in complete_days]
+
+    def replace_days(self, first_day: date, last_day: date, sales: Iterable[Sale], today: date = None) -> int:
+        """
+        Replace the buckets of first_day to last_day with the sales completed on those days
+        :param sales: completed sales with SaleLines.Item loaded
+        :param today: days before today are marked complete
+        :return: number of sale lines stored
+        """
+        today = today or self.today()
+        first, last = first_day.isoformat(), last_day.isoformat()
+        line_rows, item_rows = [], dict()
+        for sale in sales:
+            if not sale.completeTime:
+                continue
+            day = sale.completeTime.astimezone(self.timezone).date().isoformat()
+            if not first <= day <= last:
+                continue
+            for line in sale.SaleLines:
+                item = line.Item
+                if not item or not item.get('systemSku'):
+                    continue
+                line_rows.append((line.saleLineID, day, item['systemSku'], line.unitQuantity, line.revenue))
+                item_rows[item['systemSku']] = json.dumps(item)
+        with closing(self.connect()) as db, db:
+            db.execute("DELETE FROM sale_line WHERE day BETWEEN ? AND ?", (first, last))
+            db.executemany("INSERT OR REPLACE INTO sale_line (sale_line_id, day, system_sku, units, revenue) "
+                           "VALUES (?, ?, ?, ?, ?)", line_rows)
+            db.executemany("INSERT OR REPLACE INTO sale_item (system_sku, item_json) VALUES (?, ?)",
+                           item_rows.items())
+            day = first_day
+            while day <= last_day:
+                db.execute("INSERT OR REPLACE INTO sale_day (day, complete) VALUES (?, ?)",
+                           (day.isoformat(), day < today))
+                day += timedelta(days=1)
+        return len(line_rows)
+
+    def prune(self, first_day: date) -> None:
+        """
+        Drop buckets before first_day
+        """
+        with closing(self.connect()) as db, db:
+            db.execute("DELETE FROM sale_line WHERE day < ?", (first_day.isoformat(),))
+            db.execute("DELETE FROM sale_day WHERE day < ?", (first_day.isoformat(),))
+            db.execute("DELETE FROM sale_item WHERE system_sku NOT IN (SELECT system_sku FROM sale_line)")
+
+    def sold_items(self, first_day: date) -> Iterator[Dict]:
+        """
+        Items sold since first_day, as they were in their latest sale
+        """
+        with closing(self.connect()) as db:
+            rows = db.execute("""
+                SELECT item_json FROM sale_item
+                WHERE system_sku IN (SELECT system_sku FROM sale_line WHERE day >= ?)
+                ORDER BY system_sku""", (first_day.isoformat(),))
+            for (item_json,) in rows:
+                yield json.loads(item_json)
+
+    def velocity(self, windows: List[int] = None, today: date = None) -> SalesVelocity:
+        """
+        Units and revenue per SKU over the last windows days, today included
+        """
+        windows = windows or VELOCITY_DAYS
+        today = today or self.today()
+        first_day = today - timedelta(days=max(windows) - 1)
+        with closing(self.connect()) as db:
+            rows = db.execute("""
+                SELECT day, system_sku, SUM(units), SUM(revenue) FROM sale_line WHERE day >= ?
+                GROUP BY day, system_sku""", (first_day.isoformat(),)).fetchall()
+        if not rows:
+            return SalesVelocity([], np.zeros((0, len(windows)), dtype=np.int64), np.zeros((0, len(windows))), windows)
+        days, system_skus, units, revenue = zip(*rows)
+        skus, sku_index = np.unique(np.array(system_skus, dtype=object), return_inverse=True)
+        age = today.toordinal() - np.array([date.fromisoformat(day).toordinal() for day in days])
+        units = np.array(units, dtype=np.int64)
+        revenue = np.array(revenue, dtype=float)
+        window_units = np.zeros((len(skus), len(windows)), dtype=np.int64)
+        window_revenue = np.zeros((len(skus), len(windows)))
+        for column, window in enumerate(windows):
+            in_window = age < window
+            window_units[:, column] = np.bincount(sku_index[in_window], weights=units[in_window], minlength=len(skus))
+            window_revenue[:, column] = np.bincount(sku_index[in_window], weights=revenue[in_window],
+                                                    minlength=len(skus))
+        return SalesVelocity(list(skus), window_units, window_revenue, windows)
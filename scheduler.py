@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from typing import Callable, List
+
+
+class ScheduledJob:
+    def __init__(self, name: str, func: Callable[[], None], interval: float):
+        """
+        :param name: job name for logging
+        :param func: job to run
+        :param interval: seconds between the start of each run
+        """
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.next_run = time.monotonic()
+        self.__running = threading.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self.__running.locked()
+
+    def try_start(self) -> bool:
+        """
+        Start the job on its own thread, unless the previous run is still going.
+        :return: False if the run was skipped
+        """
+        self.next_run += self.interval
+        # Catch up after a long run or a suspended machine instead of firing a burst of missed runs.
+        self.next_run = max(self.next_run, time.monotonic())
+        if not self.__running.acquire(blocking=False):
+            logging.warning(f"Skipping {self.name}, the previous run is still going")
+            return False
+        threading.Thread(target=self.__run, name=self.name, daemon=True).start()
+        return True
+
+    def __run(self) -> None:
+        time_start = time.monotonic()
+        try:
+            logging.info(f"Starting {self.name}")
+            self.func()
+        except Exception:
+            logging.exception(f"Error in {self.name}")
+        finally:
+            self.__running.release()
+            logging.info(f"Finished {self.name} in {time.monotonic() - time_start:.1f} sec")
+
+
+class JobScheduler:
+    """
+    Runs jobs on fixed intervals inside one long-running process.
+    A job never overlaps with itself, a run that comes due while the previous one is going is skipped.
+    """
+
+    def __init__(self):
+        self.jobs: List[ScheduledJob] = []
+        self.__stop = threading.Event()
+
+    def add_job(self, name: str, func: Callable[[], None], interval: float) -> ScheduledJob:
+        if interval <= 0:
+            raise ValueError(f"Interval for {name} must be positive, got {interval}")
+        job = ScheduledJob(name, func, interval)
+        self.jobs.append(job)
+        logging.info(f"Scheduled {name} every {interval} sec")
+        return job
+
+    def run_forever(self) -> None:
+        try:
+            while not self.__stop.is_set():
+                now = time.monotonic()
+                for job in self.jobs:
+                    if job.next_run <= now:
+                        job.try_start()
+                next_run = min([job.next_run for job in self.jobs], default=now + 60)
+                self.__stop.wait(max(0.0, next_run - time.monotonic()))
+        except KeyboardInterrupt:
+            logging.info("Stopping scheduler")
+        finally:
+            self.wait_for_jobs()
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def wait_for_jobs(self, timeout: float = None) -> None:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while any(job.is_running for job in self.jobs):
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            time.sleep(0.1)
@@ -1,8 +1,145 @@
-from flask import Flask
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Optional, Tuple
 
-app = Flask(__name__)
+from flask import Flask, Response, request
 
+from workload import Workload
+from workorderstore import WorkorderStore
+
+FINISHED_STATUSES = ['Done & Paid', 'Finished']
+
+
+class ScheduleView:
+    """
+    Schedule aggregates of the local workorder history, precomputed and held as ready to send json.
+    They are rebuilt only when the store has synced newer workorders, the day has changed or the employees or
+    statuses have, and the store is checked at most every refresh_interval seconds, so polling clients cost almost
+    nothing.
+    """
+    RESOURCES = ['workload', 'status_counts', 'upcoming']
+
+    def __init__(self, store: WorkorderStore, employees: Callable[[], Dict[int, str]],
+                 statuses: Callable[[], Dict[int, str]], num_days: int = 21, upcoming_count: int = 50,
+                 refresh_interval: float = 5):
+        """
+        :param employees: returns the current employee id to name
+        :param statuses: returns the current workorder status id to name
+        :param num_days: workorders checked in over the last num_days are shown
+        :param upcoming_count: number of upcoming ETAs shown
+        :param refresh_interval: seconds between checks of the store for new workorders
+        """
+        self.store = store
+        self.employees = employees
+        self.statuses = statuses
+        self.num_days = num_days
+        self.upcoming_count = upcoming_count
+        self.refresh_interval = refresh_interval
+        self.__version: Optional[Tuple] = None
+        self.__checked = 0.0
+        self.__responses: Dict[str, Tuple[bytes, str]] = dict()
+        self.__lock = threading.Lock()
+
+    def get(self, resource: str) -> Tuple[bytes, str]:
+        """
+        :param resource: one of RESOURCES, or 'schedule' for all of them
+        :return: json body and its ETag
+        """
+        self.refresh()
+        return self.__responses[resource]
+
+    def refresh(self, force: bool = False) -> bool:
+        """
+        Rebuild the aggregates if the store changed
+        :return: True if they were rebuilt
+        """
+        with self.__lock:
+            now = time.monotonic()
+            if not force and self.__responses and now - self.__checked < self.refresh_interval:
+                return False
+            self.__checked = now
+            version = (self.store.get_timestamp(), date.today(), self.employees(), self.statuses())
+            if not force and version == self.__version:
+                return False
+            time_start = time.monotonic()
+            aggregates = self.__aggregate(*version[2:])
+            aggregates['schedule'] = dict([(resource, aggregates[resource]) for resource in ScheduleView.RESOURCES])
+            responses = dict()
+            for resource, aggregate in aggregates.items():
+                body = json.dumps(aggregate).encode('utf-8')
+                responses[resource] = (body, hashlib.sha1(body).hexdigest())
+            self.__responses = responses
+            self.__version = version
+            logging.info(f"Refreshed schedule view for workorders up to {version[0]} "
+                         f"in {time.monotonic() - time_start:.2f} sec")
+            return True
+
+    def __aggregate(self, employees: Dict[int, str], statuses: Dict[int, str]) -> Dict:
+        time_in_after = (datetime.now() - timedelta(days=self.num_days)).isoformat("T", "seconds")
+        workorders = list(self.store.workorders(time_in_after))
+        finished_status_ids = set([status_id for status_id, name in statuses.items()
+                                   if name in FINISHED_STATUSES])
+        open_workorders = [workorder for workorder in workorders
+                           if workorder.workorderStatusID not in finished_status_ids]
+
+        status_counts = Counter([(workorder.employeeID, workorder.workorderStatusID) for workorder in workorders])
+        now = datetime.now().astimezone()
+        upcoming = sorted([workorder for workorder in open_workorders if workorder.etaOut and workorder.etaOut >= now],
+                          key=lambda workorder: workorder.etaOut)[:self.upcoming_count]
+        return {
+            'workload': Workload.from_workorders(open_workorders, employees).to_json(),
+            'status_counts': [{'employeeID': employee_id,
+                               'employee': employees.get(employee_id, ''),
+                               'status': statuses.get(status_id, ''),
+                               'count': count}
+                              for (employee_id, status_id), count in sorted(status_counts.items())],
+            'upcoming': [{'workorderID': workorder.workorderID,
+                          'employee': employees.get(workorder.employeeID, ''),
+                          'status': statuses.get(workorder.workorderStatusID, ''),
+                          'etaOut': workorder.etaOut.isoformat()}
+                         for workorder in upcoming]
+        }
+
+
+def create_app(view: ScheduleView) -> Flask:
+    app = Flask(__name__)
+
+    def respond(resource: str) -> Response:
+        body, etag = view.get(resource)
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Let clients keep their copy, but check back every time.
+        response.cache_control.no_cache = True
+        return response
+
+    @app.route('/')
+    def schedule():
+        return respond('schedule')
+
+    @app.route('/workload')
+    def workload():
+        return respond('workload')
+
+    @app.route('/status-counts')
+    def status_counts():
+        return respond('status_counts')
+
+    @app.route('/upcoming')
+    def upcoming():
+        return respond('upcoming')
+
+    return app
+
+
+def serve_schedule_view(view: ScheduleView, host: str = '127.0.0.1', port: int = 5000) -> None:
+    view.refresh(force=True)
+    create_app(view).run(host=host, port=port, threaded=True)
 
-@app.route('/')
-def hello():
-    return "Hello World!"
\ No newline at end of file
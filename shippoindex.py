@@ -0,0 +1,63 @@
+import json
+import logging
+import os
+from typing import Set, Iterable, Optional
+
+
+class ShippoOrderIndex:
+    """
+    Local index of the order numbers already in Shippo, plus a high-water mark of the newest order seen.
+    Lets each sync only request the Shippo pages created since the last run.
+    """
+
+    def __init__(self, index_file: Optional[str] = None):
+        """
+        :param index_file: json file to persist the index to, None keeps it in memory only
+        """
+        self.index_file = index_file
+        self.order_numbers: Set[str] = set()
+        self.high_water_mark: Optional[str] = None
+        self.load()
+
+    def __contains__(self, order_number: str) -> bool:
+        return order_number in self.order_numbers
+
+    def __len__(self) -> int:
+        return len(self.order_numbers)
+
+    def load(self) -> None:
+        if not self.index_file or not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file) as f:
+                index_json: dict = json.load(f)
+            self.order_numbers = set(index_json.get('order_numbers', []))
+            self.high_water_mark = index_json.get('high_water_mark')
+            logging.info(f"Loaded {len(self.order_numbers)} Shippo order numbers from {self.index_file}")
+        except (IOError, ValueError):
+            logging.warning(f"Could not read Shippo order index {self.index_file}, it will be rebuilt")
+            self.clear()
+
+    def save(self) -> None:
+        if not self.index_file:
+            return
+        # Write to a temporary file and swap it in, so a crash never leaves a half-written index.
+        temp_file = f"{self.index_file}.tmp"
+        with open(temp_file, 'w') as f:
+            json.dump({'high_water_mark': self.high_water_mark,
+                       'order_numbers': sorted(self.order_numbers)}, f)
+        os.replace(temp_file, self.index_file)
+
+    def clear(self) -> None:
+        self.order_numbers = set()
+        self.high_water_mark = None
+
+    def update(self, order_numbers: Iterable[str], newest_created: Optional[str] = None) -> None:
+        """
+        Add order numbers to the index
+        :param order_numbers: Shippo order numbers, e.g. '#1234'
+        :param newest_created: Shippo object_created timestamp of the newest order in the batch
+        """
+        self.order_numbers.update(order_numbers)
+        if newest_created and (not self.high_water_mark or newest_created > self.high_water_mark):
+            self.high_water_mark = newest_created
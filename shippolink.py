@@ -1,11 +1,15 @@
+import hashlib
 import logging
 import shippo
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
-from typing import List, Dict, Union, Set, Iterator, Tuple
+from typing import List, Dict, Union, Set, Iterator, Tuple, Optional, Iterable
 
-import requests
 from smartetailing import objects
 from httpconnection import HttpConnectionBase
+from responsecache import ResponseCache
+from runreport import span, submit_in_context
+from shippoindex import ShippoOrderIndex
 
 
 class ShippoConstants:
@@ -20,10 +24,26 @@ class ShippoOrderStatus:
     PAID = "PAID"
 
 
+class ShippoSyncResult:
+    """
+    Per-order outcome of a send_to_shippo batch
+    """
+
+    def __init__(self):
+        self.created: List[str] = []
+        self.failed: Dict[str, str] = dict()
+
+    def __str__(self):
+        return f"created={len(self.created)} failed={len(self.failed)}"
+
+
 class ShippoConnection(HttpConnectionBase):
     SHIPPO_BASE_URL = "https://api.goshippo.com/orders/"
 
-    def __init__(self, api_key: str, skip_shipping_classification=None, include_order_status=None):
+    def __init__(self, api_key: str, skip_shipping_classification=None, include_order_status=None,
+                 index_file: str = None, timeout=None, max_workers: int = None, max_retries: int = None,
+                 base_url: str = None, response_cache: ResponseCache = None, cache_ttls: Dict[str, float] = None):
+        super().__init__(timeout, max_workers, max_retries, response_cache, cache_ttls)
         if skip_shipping_classification is None:
             skip_shipping_classification = ["in-store pickup", "store pickup"]
         if include_order_status is None:
@@ -31,75 +51,172 @@ class ShippoConnection(HttpConnectionBase):
 
         shippo.config.api_key = api_key
         self.__api_key = api_key
-        self.__existing_shippo_order_ids: Set[str] = set()
+        # Orders of different Shippo accounts share the same URLs
+        self.cache_scope = hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+        self.base_url = base_url or ShippoConnection.SHIPPO_BASE_URL
+        self.__order_index = ShippoOrderIndex(index_file)
+        self.__order_index_synced = False
+        self.__order_index_future: Optional[Future] = None
         self.__skip_shipping_classification = skip_shipping_classification
         self.__include_order_status = include_order_status
 
     @property
     def existing_shippo_order_ids(self) -> Set[str]:
-        if not self.__existing_shippo_order_ids or len(self.__existing_shippo_order_ids) == 0:
-            self.__existing_shippo_order_ids = self.__get_existing_shippo_order_ids()
-        return self.__existing_shippo_order_ids
+        return self.order_index.order_numbers
 
-    def send_to_shippo(self, return_address: Dict[str, str], orders: Iterator[objects.Order]) -> List[str]:
-        shippo_orders: Iterator[objects.Order] = list(self.skip_existing_orders(
+    @property
+    def order_index(self) -> ShippoOrderIndex:
+        if self.__order_index_future is not None:
+            # Wait for the prefetch, and surface any error it hit. The future is dropped either way,
+            # so a failed prefetch is retried by the next sync instead of raising the same error for good.
+            future, self.__order_index_future = self.__order_index_future, None
+            future.result()
+        if not self.__order_index_synced:
+            self.sync_order_index()
+        return self.__order_index
+
+    def prefetch_order_index(self) -> None:
+        """
+        Start an incremental sync of the order index in the background, e.g. while the orders are being exported.
+        The order_index property waits for it to finish.
+        """
+        if self.__order_index_future is not None:
+            return
+        # Own thread rather than the worker pool, since the sync itself fetches pages on the worker pool.
+        prefetch_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ShippoOrderIndex")
+        self.__order_index_future = submit_in_context(prefetch_executor, self.sync_order_index)
+        prefetch_executor.shutdown(wait=False)
+
+    def sync_order_index(self, rebuild: bool = False) -> ShippoOrderIndex:
+        """
+        Pull the Shippo orders created since the index high-water mark into the local index
+        :param rebuild: discard the local index and page through every Shippo order
+        :return: the synced index
+        """
+        if rebuild:
+            logging.info("Rebuilding Shippo order index")
+            self.__order_index.clear()
+        with span('shippo.index', 'rebuild' if rebuild else 'incremental') as data:
+            try:
+                self.__update_order_index()
+            except Exception:
+                # The next read of order_index syncs again, from the high-water mark the failed sync left alone.
+                self.__order_index_synced = False
+                raise
+            self.__order_index.save()
+            data['orders'] = len(self.__order_index)
+        self.__order_index_synced = True
+        logging.info(f"Shippo order index has {len(self.__order_index)} orders")
+        return self.__order_index
+
+    def send_to_shippo(self, return_address: Dict[str, str], orders: Iterable[objects.Order]) -> ShippoSyncResult:
+        """
+        Create each order in Shippo as soon as it passes the filters, without holding the whole export in memory.
+        Up to max_workers orders are created at once, one failed order doesn't stop the rest of the batch.
+        :param return_address: Shippo from address
+        :param orders: exported orders, consumed lazily
+        :return: created and failed order ids
+        """
+        self.prefetch_order_index()
+        shippo_orders: Iterator[objects.Order] = self.skip_existing_orders(
             self.use_only_received_orders(
-                self.skip_in_store_pickup(orders))))
-        created_orders = []
+                self.skip_in_store_pickup(orders)))
+        result = ShippoSyncResult()
+        pending: Dict[Future, str] = dict()
         for order in shippo_orders:
-            order_json = create_shippo_order(return_address, order)
-            self.__create_order(order_json)
-            created_orders.append(order.id)
-        return created_orders
-
-    def skip_existing_orders(self, orders: Iterator[objects.Order]) -> Iterator[objects.Order]:
+            # Bound the orders in flight, so a large export doesn't queue up in memory.
+            if len(pending) >= 2 * self.max_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                self.__collect_created_orders(done, pending, result)
+            pending[submit_in_context(self.executor, self.__create_order,
+                                      create_shippo_order(return_address, order))] = order.id
+        self.__collect_created_orders(wait(pending).done, pending, result)
+        self.__order_index.save()
+        logging.info(f"Shippo sync {result}")
+        return result
+
+    @staticmethod
+    def __collect_created_orders(done: Iterable[Future], pending: Dict[Future, str],
+                                 result: ShippoSyncResult) -> None:
+        for future in done:
+            order_id = pending.pop(future)
+            try:
+                future.result()
+                result.created.append(order_id)
+            except Exception as err:
+                logging.error(f"FAILED: Order #{order_id} {err}")
+                result.failed[order_id] = str(err)
+
+    def skip_existing_orders(self, orders: Iterable[objects.Order]) -> Iterator[objects.Order]:
         for order in orders:
-            if '#' + order.id in self.existing_shippo_order_ids:
+            if '#' + order.id in self.order_index:
                 logging.info(f"SKIPPED: Order #{order.id} already in Shippo")
             else:
                 yield order
 
-    def skip_in_store_pickup(self, orders: Iterator[objects.Order]) -> Iterator[objects.Order]:
+    def skip_in_store_pickup(self, orders: Iterable[objects.Order]) -> Iterator[objects.Order]:
         for order in orders:
             if order.shipping.classification.lower() in self.__skip_shipping_classification:
                 logging.info(f"SKIPPED: Order #{order.id} shipping={order.shipping.classification}")
             else:
                 yield order
 
-    def use_only_received_orders(self, orders: Iterator[objects.Order]) -> Iterator[objects.Order]:
+    def use_only_received_orders(self, orders: Iterable[objects.Order]) -> Iterator[objects.Order]:
         for order in orders:
             if order.status.lower() in self.__include_order_status:
                 yield order
             else:
                 logging.info(f"SKIPPED: Order #{order.id} in status={order.status}")
 
-    def __get_existing_shippo_order_ids_paged(self, page=1, page_size=50) -> Tuple[Set[str],bool]:
-        response = requests.get(ShippoConnection.SHIPPO_BASE_URL, headers={
+    def __get_shippo_orders_paged(self, page=1, page_size=50) -> Tuple[List[dict], bool]:
+        # Orders change all the time, so they're only cached if cache_ttls gives 'orders' a TTL.
+        response = self._get(self.base_url, cache_resource='orders', headers={
             "Authorization": f"ShippoToken {self.__api_key}",
         }, params={'results': str(page_size), 'page': str(page)})
         self._handle_response(response)
-        response_json = response.json()
-        order_numbers = set([obj["order_number"] for obj in response_json["results"]])
-        return order_numbers, len(order_numbers) == page_size
-
-    def __get_existing_shippo_order_ids(self) -> Set[str]:
-        order_number_set = set()
-        # Shippo doesn't currently report the paging correctly, so just request until we get an empty list back.
+        page_orders = response.json()["results"]
+        return page_orders, len(page_orders) == page_size
+
+    def __update_order_index(self) -> None:
+        high_water_mark = self.__order_index.high_water_mark
+        # Shippo doesn't currently report the paging correctly, so just request until we get a short page back.
+        # Orders come back newest first, so stop once a page reaches orders already covered by the index.
+        # The first page goes alone since incremental syncs usually end there, later pages are fetched in parallel.
+        # The high-water mark only moves once every page is indexed, so a sync that fails partway starts over.
+        newest_created = None
         page = 1
+        batch_size = 1
         has_next_page = True
         while has_next_page:
-            page_set, has_next_page = self.__get_existing_shippo_order_ids_paged(page)
-            order_number_set = order_number_set.union(page_set)
-            page += 1
-
-        return order_number_set
+            pages = list(range(page, page + batch_size))
+            for page_orders, page_has_next in self._map_concurrent(self.__get_shippo_orders_paged, pages):
+                created_times = self.__index_page(page_orders)
+                if created_times:
+                    newest_created = max([newest_created or ''] + created_times)
+                has_next_page = page_has_next and not (
+                    high_water_mark and any(created <= high_water_mark for created in created_times))
+                if not has_next_page:
+                    break
+            page += batch_size
+            batch_size = self.max_workers
+        self.__order_index.update([], newest_created)
+
+    def __index_page(self, page_orders: List[dict]) -> List[str]:
+        """
+        Add a page of Shippo orders to the index
+        :return: object_created of the page's orders
+        """
+        self.__order_index.update([obj["order_number"] for obj in page_orders])
+        return [obj["object_created"] for obj in page_orders if obj.get("object_created")]
 
     def __create_order(self, order_json: dict) -> None:
-        response = requests.post(ShippoConnection.SHIPPO_BASE_URL, headers={
-            "Authorization": f"ShippoToken {self.__api_key}",
-        }, json=order_json)
-        # Assert success
-        self._handle_response(response)
+        with span('shippo.create_order', order_json['order_number']):
+            response = self._post(self.base_url, headers={
+                "Authorization": f"ShippoToken {self.__api_key}",
+            }, json=order_json)
+            # Assert success
+            self._handle_response(response)
+        self.__order_index.update([order_json['order_number']])
         logging.info(f"Created shippo order {order_json['order_number']}")
 
 
@@ -0,0 +1,26 @@
+import os
+import sqlite3
+from contextlib import closing
+
+
+class SQLiteStore:
+    """
+    A table set in a local SQLite file, created on first use from SCHEMA.
+    Each operation opens its own connection, so the jobs and worker threads can share a store.
+    Several stores live in the same file, e.g. the inventory, sales and workorder stores in cache_file, so writers
+    read their whole download before the write transaction opens: a slow page mustn't hold the file's write lock.
+    """
+    SCHEMA = ''
+
+    def __init__(self, db_file: str):
+        """
+        :param db_file: relative paths are from this directory
+        """
+        if not os.path.isabs(db_file):
+            db_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), db_file)
+        self.db_file = db_file
+        with closing(self.connect()) as db, db:
+            db.executescript(type(self).SCHEMA)
+
+    def connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_file)
@@ -0,0 +1,104 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Sequence
+
+from runreport import span, submit_in_context
+
+
+class StageError(RuntimeError):
+    """
+    A stage that raised, the original error is the cause
+    """
+
+    def __init__(self, stage: str, error: BaseException, skipped: List[str] = None):
+        """
+        :param stage: name of the stage that failed first
+        :param error: its error
+        :param skipped: stages that never ran because of it
+        """
+        self.stage = stage
+        self.error = error
+        self.skipped = skipped or []
+        message = f"Stage {stage} failed: {type(error).__name__}: {error}"
+        if self.skipped:
+            message += f", skipped {', '.join(self.skipped)}"
+        super().__init__(message)
+
+
+class Stage:
+    def __init__(self, name: str, func: Callable[..., Any], requires: Sequence[str]):
+        """
+        :param func: called with the results of the required stages, in the order of requires
+        :param requires: stages that must finish first
+        """
+        self.name = name
+        self.func = func
+        self.requires = list(requires)
+
+
+class StageRunner:
+    """
+    Runs stages on a thread pool as soon as the stages they require have finished, so independent stages overlap
+    and the run takes about as long as its longest chain of stages.
+    Stages can only require stages added before them, which keeps the graph free of cycles.
+    The first error stops any more stages from starting, and once the running ones finish it is raised as a
+    StageError naming the stage.
+    """
+
+    def __init__(self, max_workers: int = None):
+        """
+        :param max_workers: stages running at once, every stage that is ready by default
+        """
+        self.max_workers = max_workers
+        self.stages: Dict[str, Stage] = dict()
+
+    def add(self, name: str, func: Callable[..., Any], requires: Sequence[str] = ()) -> 'StageRunner':
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already added")
+        for required in requires:
+            if required not in self.stages:
+                raise ValueError(f"Stage {name} requires {required}, which must be added before it")
+        self.stages[name] = Stage(name, func, requires)
+        return self
+
+    def run(self) -> Dict[str, Any]:
+        """
+        :return: stage name to its result
+        """
+        results: Dict[str, Any] = dict()
+        pending: Dict[str, Stage] = dict(self.stages)
+        running: Dict[Future, Stage] = dict()
+        errors: Dict[str, BaseException] = dict()
+        max_workers = self.max_workers or max(1, len(self.stages))
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='stage') as executor:
+            while pending or running:
+                if not errors:
+                    for stage in [stage for stage in pending.values()
+                                  if all([required in results for required in stage.requires])]:
+                        del pending[stage.name]
+                        arguments = [results[required] for required in stage.requires]
+                        running[submit_in_context(executor, self.__run_stage, stage, arguments)] = stage
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        results[stage.name] = future.result()
+                    else:
+                        logging.error(f"Stage {stage.name} failed: {type(error).__name__}: {error}")
+                        errors[stage.name] = error
+        if errors:
+            stage, error = next(iter(errors.items()))
+            raise StageError(stage, error, list(pending)) from error
+        return results
+
+    @staticmethod
+    def __run_stage(stage: Stage, arguments: List[Any]) -> Any:
+        time_start = time.monotonic()
+        with span('stage', stage.name):
+            result = stage.func(*arguments)
+        logging.info(f"Stage {stage.name} finished in {time.monotonic() - time_start:.1f} sec")
+        return result
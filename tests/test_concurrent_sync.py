@@ -0,0 +1,84 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from fakecatalog import FakeCatalog
+from lightspeedconnection import LightspeedConnection
+from lightspeedobjects import Sale
+
+
+class ConcurrentSyncTest(unittest.TestCase):
+    """
+    inventory_spreadsheet syncs the inventory and the sales at the same time, into the same cache file.
+    """
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.connection = LightspeedConnection(os.path.join(self.temp_dir.name, 'cache.db'), '1', 'client', 'secret',
+                                               'token', timezone='UTC')
+        self.catalog = FakeCatalog(200)
+        # Sales of the last few days, so they fall in the synced days whatever today is.
+        today = datetime.now(timezone.utc).date()
+        self.sales = self.catalog.sales(50)
+        for index, sale in enumerate(self.sales):
+            sale['completeTime'] = f'{today - timedelta(days=index % 5)}T12:00:00+00:00'
+
+    def tearDown(self):
+        self.connection.close()
+        self.temp_dir.cleanup()
+
+    def test_slow_inventory_download_does_not_block_sales_sync(self):
+        sales_synced = threading.Event()
+
+        def get_records(source, parameters=None):
+            self.assertEqual('Item', source)
+            items = self.catalog.items()
+            yield from items[:100]
+            # A slow page, still downloading until the sales sync has written its days.
+            sales_synced.wait(timeout=30)
+            yield from items[100:]
+
+        def get_sales(start_date, end_date=None):
+            return map(Sale.from_json, self.sales)
+
+        self.connection.get_records = get_records
+        self.connection.get_sales = get_sales
+        errors = []
+
+        def sync_inventory():
+            try:
+                self.connection.sync_inventory(full_sync=True)
+            except Exception as err:
+                errors.append(err)
+
+        def sync_sales():
+            try:
+                self.connection.sync_sales(datetime.now(timezone.utc).date() - timedelta(days=30))
+            except Exception as err:
+                errors.append(err)
+            finally:
+                sales_synced.set()
+
+        threads = [threading.Thread(target=sync_inventory), threading.Thread(target=sync_sales)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+
+        self.assertEqual([], errors)
+        self.assertTrue(sales_synced.is_set())
+        in_stock_count = len([item for item in self.catalog.items() if self.in_stock(item)])
+        self.assertEqual(in_stock_count, len(list(self.connection.inventory_store.in_stock_items())))
+        self.assertTrue(list(self.connection.sales_store.sold_items(datetime.now(timezone.utc).date() - timedelta(days=30))))
+
+    @staticmethod
+    def in_stock(item) -> bool:
+        shops = item['ItemShops']['ItemShop']
+        shops = shops if isinstance(shops, list) else [shops]
+        return any([int(shop['qoh']) > 0 for shop in shops])
+
+
+if __name__ == '__main__':
+    unittest.main()
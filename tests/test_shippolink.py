@@ -0,0 +1,58 @@
+import unittest
+from typing import Dict, Tuple
+
+from fakeservers import FakeShippoServer
+from shippolink import ShippoConnection
+
+
+class FailingPageShippoServer(FakeShippoServer):
+    """
+    Fails every request for one page of the orders
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failing_page = None
+
+    def handle(self, method: str, path: str, query: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+        if method == 'GET' and query.get('page') == self.failing_page:
+            return 500, 'text/plain', b'Internal Server Error'
+        return super().handle(method, path, query, body)
+
+
+class ShippoOrderIndexSyncTest(unittest.TestCase):
+    """
+    A connection is kept for the life of serve, so a failed order index sync must not stick to it.
+    """
+
+    def setUp(self):
+        self.server = FailingPageShippoServer([f'#{order_id}' for order_id in range(100000, 100500)]).start()
+        self.connection = ShippoConnection('key', base_url=self.server.url, max_retries=0, max_workers=4)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+
+    def test_failed_prefetch_is_retried(self):
+        self.server.failure_rate = 1.0
+        self.connection.prefetch_order_index()
+        with self.assertRaises(RuntimeError):
+            self.connection.order_index
+        self.assertEqual(1, self.server.request_count)
+
+        self.server.failure_rate = 0.0
+        self.assertEqual(500, len(self.connection.order_index))
+        self.assertGreater(self.server.request_count, 1)
+
+    def test_failed_full_sync_indexes_older_pages_next_time(self):
+        self.server.failing_page = '4'
+        with self.assertRaises(RuntimeError):
+            self.connection.sync_order_index()
+
+        self.server.failing_page = None
+        self.assertEqual(500, len(self.connection.order_index))
+        self.assertEqual(self.server.orders[-1]['object_created'], self.connection.order_index.high_water_mark)
+
+
+if __name__ == '__main__':
+    unittest.main()
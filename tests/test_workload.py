@@ -0,0 +1,21 @@
+import os
+import tempfile
+import unittest
+
+from lightspeedobjects import Workorder
+from workload import Workload
+
+
+class WorkloadTest(unittest.TestCase):
+
+    def test_save_png_without_assigned_workorders(self):
+        workorder = Workorder.from_json({'workorderID': '1', 'employeeID': '0', 'timeIn': '2023-06-01T10:00:00-04:00'})
+        workload = Workload.from_workorders([workorder], {1: 'Alice', 2: 'Bob'})
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_file = os.path.join(temp_dir, 'workload.png')
+            workload.save(output_file)
+            self.assertGreater(os.path.getsize(output_file), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
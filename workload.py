@@ -0,0 +1,122 @@
+import csv
+import json
+import logging
+import os
+from typing import Dict, Iterable, List, TextIO
+
+import numpy as np
+
+from lightspeedobjects import Workorder
+
+WORKLOAD_FORMATS = ['.png', '.csv', '.json']
+
+
+def workorder_days(workorders: List[Workorder]) -> np.ndarray:
+    """
+    First and last day of each workorder, from timeIn to etaOut in the shop's local dates
+    :return: workorders x 2 array of datetime64[D], a missing etaOut ends on the timeIn day
+    """
+    # Lightspeed's timestamps carry the shop's UTC offset, so their dates are already local.
+    time_in = np.array([workorder.timeIn.date() if workorder.timeIn else None for workorder in workorders],
+                       dtype='datetime64[D]')
+    eta_out = np.array([workorder.etaOut.date() if workorder.etaOut else None for workorder in workorders],
+                       dtype='datetime64[D]')
+    eta_out = np.where(np.isnat(eta_out), time_in, eta_out)
+    return np.sort(np.stack([time_in, eta_out], axis=1), axis=1)
+
+
+class Workload:
+    """
+    Open workorders of each employee on each day, employees x days.
+    """
+
+    def __init__(self, employee_ids: List[int], employee_names: List[str], days: np.ndarray, counts: np.ndarray):
+        self.employee_ids = employee_ids
+        self.employee_names = employee_names
+        self.days = days
+        self.counts = counts
+
+    @staticmethod
+    def from_workorders(workorders: Iterable[Workorder], employees: Dict[int, str]) -> 'Workload':
+        """
+        Build the matrix in one pass: +1 on each workorder's first day and -1 after its last, summed along the days.
+        :param employees: employee id to name, the matrix rows in this order
+        """
+        employee_ids = list(employees.keys())
+        employee_rows = dict([(employee_id, row) for row, employee_id in enumerate(employee_ids)])
+        workorders = [workorder for workorder in workorders if workorder.timeIn]
+        rows = np.array([employee_rows.get(workorder.employeeID, -1) for workorder in workorders],
+                        dtype=np.int64)
+        assigned = rows >= 0
+        if not assigned.all():
+            logging.info(f"Skipping {np.count_nonzero(~assigned)} workorders without a known employee")
+        rows = rows[assigned]
+        workorder_ranges = workorder_days(workorders)[assigned]
+        if not len(workorder_ranges):
+            return Workload(employee_ids, list(employees.values()), np.array([], dtype='datetime64[D]'),
+                            np.zeros((len(employee_ids), 0), dtype=np.int64))
+
+        first_day = workorder_ranges[:, 0].min()
+        starts = (workorder_ranges[:, 0] - first_day).astype(np.int64)
+        ends = (workorder_ranges[:, 1] - first_day).astype(np.int64) + 1
+        day_count = int(ends.max())
+        changes = np.zeros((len(employee_ids), day_count + 1), dtype=np.int64)
+        np.add.at(changes, (rows, starts), 1)
+        np.add.at(changes, (rows, ends), -1)
+        counts = np.cumsum(changes, axis=1)[:, :day_count]
+        days = first_day + np.arange(day_count)
+        return Workload(employee_ids, list(employees.values()), days, counts)
+
+    def write_csv(self, stream: TextIO) -> None:
+        writer = csv.writer(stream)
+        writer.writerow(['Employee'] + [str(day) for day in self.days])
+        for name, counts in zip(self.employee_names, self.counts.tolist()):
+            writer.writerow([name] + counts)
+
+    def to_json(self) -> Dict:
+        return {'days': [str(day) for day in self.days],
+                'employees': [{'employeeID': employee_id, 'name': name, 'workload': counts}
+                              for employee_id, name, counts in
+                              zip(self.employee_ids, self.employee_names, self.counts.tolist())]}
+
+    def save_png(self, output_file: str) -> None:
+        # A bare Figure needs no GUI backend, so this works from cron or a server thread.
+        from matplotlib.figure import Figure
+
+        fig = Figure(figsize=(10, 6))
+        ax = fig.add_subplot()
+        if not self.counts.size:
+            # A quiet spell, or every workorder unassigned. An empty chart still replaces yesterday's.
+            logging.info("No open workorders with a known employee, saving an empty workload chart")
+            ax.set_axis_off()
+            ax.text(0.5, 0.5, 'No open workorders', ha='center', va='center')
+            fig.savefig(output_file)
+            return
+        x = [day.item() for day in self.days]
+        y = np.arange(0, len(self.employee_ids), 1)
+        pmesh = ax.pcolormesh(x, y, self.counts, shading='auto')
+        fig.colorbar(pmesh, ax=ax)
+        ax.set_xlabel('Date')
+        ax.set_ylabel('Employee')
+        ax.set_yticks(y, self.employee_names)
+        fig.autofmt_xdate()
+        fig.subplots_adjust(left=0.17, bottom=0.25, right=1.05)
+        fig.savefig(output_file)
+
+    def save(self, output_file: str) -> None:
+        """
+        :param output_file: .png, .csv or .json
+        """
+        extension = os.path.splitext(output_file)[1].lower()
+        if extension not in WORKLOAD_FORMATS:
+            raise ValueError(f"Cannot save workload as {extension}, expected one of {WORKLOAD_FORMATS}")
+        logging.info(f"Saving workload of {len(self.employee_ids)} employees over {len(self.days)} days "
+                     f"to {output_file}")
+        if extension == '.png':
+            self.save_png(output_file)
+        elif extension == '.csv':
+            with open(output_file, 'w', newline='') as f:
+                self.write_csv(f)
+        else:
+            with open(output_file, 'w') as f:
+                json.dump(self.to_json(), f)
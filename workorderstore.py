@@ -0,0 +1,91 @@
+import json
+from contextlib import closing
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from lightspeedobjects import Workorder
+from sqlitestore import SQLiteStore
+
+
+class WorkorderStore(SQLiteStore):
+    """
+    Local SQLite history of Lightspeed workorders, kept up to date by upserting the workorders changed since the
+    newest timeStamp stored. Indexed for the schedule queries, by employee, status and check in time.
+    """
+    WORKORDER_TIMESTAMP = 'workorder_timestamp'
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sync_state (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS workorder (
+            workorder_id INTEGER PRIMARY KEY,
+            employee_id INTEGER,
+            workorder_status_id INTEGER,
+            time_in TEXT,
+            eta_out TEXT,
+            archived INTEGER NOT NULL,
+            time_stamp TEXT,
+            workorder_json TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS workorder_employee ON workorder (employee_id, time_in);
+        CREATE INDEX IF NOT EXISTS workorder_status ON workorder (workorder_status_id, time_in);
+        CREATE INDEX IF NOT EXISTS workorder_time_in ON workorder (time_in);
+    """
+
+    def get_timestamp(self) -> Optional[str]:
+        """
+        Newest timeStamp stored, None before the first sync
+        """
+        with closing(self.connect()) as db:
+            row = db.execute("SELECT value FROM sync_state WHERE key = ?",
+                             (WorkorderStore.WORKORDER_TIMESTAMP,)).fetchone()
+        return row[0] if row else None
+
+    def upsert_workorders(self, workorders: Iterable[Dict]) -> int:
+        """
+        :param workorders: new or changed workorders
+        :return: number of workorders stored
+        """
+        rows = [(int(workorder['workorderID']), int(workorder.get('employeeID') or 0),
+                 int(workorder.get('workorderStatusID') or 0), workorder.get('timeIn'), workorder.get('etaOut'),
+                 workorder.get('archived') == 'true', workorder.get('timeStamp'), json.dumps(workorder))
+                for workorder in workorders]
+        with closing(self.connect()) as db, db:
+            row = db.execute("SELECT value FROM sync_state WHERE key = ?",
+                             (WorkorderStore.WORKORDER_TIMESTAMP,)).fetchone()
+            db.executemany("""
+                INSERT OR REPLACE INTO workorder (workorder_id, employee_id, workorder_status_id, time_in, eta_out,
+                                                  archived, time_stamp, workorder_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            newest = max([row[0] if row else ''] + [time_stamp or '' for *_, time_stamp, _ in rows]) or None
+            if newest:
+                db.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)",
+                           (WorkorderStore.WORKORDER_TIMESTAMP, newest))
+        return len(rows)
+
+    def workorders(self, time_in_after: str = None, employee_id: int = None,
+                   excluded_status_ids: List[int] = None, include_archived: bool = False) -> Iterator[Workorder]:
+        """
+        :param time_in_after: ISO timestamp, only workorders checked in after it
+        :param employee_id: only workorders assigned to the employee
+        :param excluded_status_ids: skip workorders in these statuses, e.g. finished ones
+        :param include_archived: include archived workorders
+        :return: workorders in check in order
+        """
+        conditions, parameters = [], []
+        if time_in_after:
+            conditions.append("time_in > ?")
+            parameters.append(time_in_after)
+        if employee_id is not None:
+            conditions.append("employee_id = ?")
+            parameters.append(employee_id)
+        if excluded_status_ids:
+            conditions.append(f"workorder_status_id NOT IN ({','.join(['?'] * len(excluded_status_ids))})")
+            parameters.extend(excluded_status_ids)
+        if not include_archived:
+            conditions.append("NOT archived")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        with closing(self.connect()) as db:
+            for (workorder_json,) in db.execute(f"SELECT workorder_json FROM workorder {where} ORDER BY time_in",
+                                                parameters):
+                yield Workorder.from_json(json.loads(workorder_json))
+
+    def __len__(self) -> int:
+        with closing(self.connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM workorder").fetchone()[0]
@@ -0,0 +1,74 @@
+import logging
+from typing import BinaryIO, Callable, Iterator, Union
+
+import requests
+from lxml import etree
+
+from serializer import IXMLSerializer
+
+
+def iterparse_objects(source: Union[str, BinaryIO], tag: str,
+                      serializer: Callable[[], IXMLSerializer]) -> Iterator[IXMLSerializer]:
+    """
+    Stream objects out of an XML document, one per tag element, as soon as each element has been parsed.
+    Every element is cleared once its object is built, so memory stays flat however large the document.
+    :param source: file name or binary file like object, e.g. a streamed response body
+    :param tag: element of each object
+    :param serializer: creates the object each element is read into with from_xml
+    """
+    for _, element in etree.iterparse(source, events=('end',), tag=tag):
+        yield serializer().from_xml(element)
+        element.clear(keep_tail=False)
+        # Drop the cleared elements from the root too, or their empty shells still add up.
+        parent = element.getparent()
+        while element.getprevious() is not None:
+            del parent[0]
+
+
+class SmartetailingOrderStream:
+    """
+    Smartetailing's order export read while it downloads, each order handed on as soon as it is parsed.
+    """
+    DEFAULT_TIMEOUT = (10, 300)
+
+    def __init__(self, connection, timeout=None):
+        """
+        :param connection: smartetailing.connection.SmartetailingConnection with the export credentials
+        """
+        self.connection = connection
+        self.timeout = timeout or SmartetailingOrderStream.DEFAULT_TIMEOUT
+
+    def export_orders(self) -> Iterator:
+        """
+        :return: smartetailing.objects.Order of each WebOrder in the export
+        """
+        from smartetailing.objects import WebOrder
+
+        try:
+            response = self.__request_export()
+        except ConnectionError:
+            logging.warning("Smartetailing order export unavailable, reading open orders from the web site")
+            yield from self.connection.export_orders_via_web()
+            return
+        with response:
+            response.raw.decode_content = True
+            for web_order in iterparse_objects(response.raw, 'WebOrder', WebOrder):
+                yield web_order.order
+
+    def __request_export(self) -> requests.Response:
+        response = requests.get(self.connection.base_url, params={
+            'method': 'Orders',
+            'ver': '2.00',
+            'merchant': f'{self.connection.merchant_id}',
+            'URLkey': self.connection.url_key,
+            'OrderNumber': '',
+            'OrderStatus': ''
+        }, stream=True, timeout=self.timeout)
+        # Same handling as SmartetailingConnection, a 503 means the export is down.
+        if response.status_code == 503:
+            response.close()
+            raise ConnectionError(f"Error {response}")
+        if response.status_code >= 300:
+            response.close()
+            raise RuntimeError(f"Error {response}")
+        return response